@@ -0,0 +1,453 @@
+'''
+Benchmark suite over the shipped data, to tell whether a change makes the
+parsers faster or slower:
+- the load time and peak memory of the grammar, saved as JSON and compiled
+- the throughput of the tokenizers
+- the parse latency of CKY and Earley by sentence length, their peak memory and
+  F1, on the dev sentences and on the debug grammar and tree (data/debug.raw
+  is another sentence, which the debug grammar does not cover)
+- the throughput of ParseEvaluator
+
+Every time is the median of --repeat runs. The results are written as JSON, and
+compared with a baseline written the same way: the run fails if a time or a
+memory peak is worse than the baseline by more than the tolerance, or if a
+parser no longer builds the same trees (F1 or failures changed).
+
+    python3 benchmarks/suite.py --output baseline.json
+    ... change the code ...
+    python3 benchmarks/suite.py --baseline baseline.json [--tolerance 0.2]
+
+Other options: --max-words (longest dev sentence parsed, 20), --repeat (3) and
+--quick (sentences of at most 10 words, one run), which is only a smoke test:
+its times are too noisy to compare with a tolerance of 20%.
+
+--report NAME runs one of the reports below instead, over the same --grammar,
+--sentences and --gold, and fails if its check does:
+- tokenizer: the compiled tokenizer must give the tokens of the reference one
+  on hand-picked cases, random strings and the sentences; and their speed
+- lexicon: the memory and per-token cost of each known-word lookup
+- span_cache: CKY without the span cache, then with it cold and warm, which
+  must build the same trees
+- astar: A* against CKY by sentence length, which must build the same trees,
+  and the edges A* pushed, popped and finished
+- coarse_to_fine: the time, fraction of coarse cells pruned and F1 of CKY at
+  every coarse threshold
+
+    python3 benchmarks/suite.py --report astar [--max-words 15]
+'''
+
+import argparse
+import gc
+import hashlib
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import tracemalloc
+from collections import defaultdict
+from time import perf_counter
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mylib.cache import SpanCache
+from mylib.coarse import CoarseToFineStats
+from mylib.eval import ParseError, ParseEvaluator, TreeOperations
+from mylib.grammar import Lexicon
+from mylib.parser import Parser
+from mylib.pcfg import PCFG
+from mylib.tokenizer import CompiledPennTreebankTokenizer, PennTreebankTokenizer
+
+ALGOS = ("CKY", "Earley")
+# The measures that must not get smaller, larger, or else change at all
+HIGHER_IS_BETTER = ("_per_s",)
+LOWER_IS_BETTER = ("_s", "_bytes")
+# Times closer than this to the baseline are noise, whatever the tolerance
+NOISE_S = 0.002
+
+
+def median_time(function, repeat, least=0.5):
+    # The median time of repeat calls of function, in seconds, with more calls
+    # if they do not add up to least seconds
+    times = []
+    while len(times) < repeat or sum(times) < least:
+        gc.collect()
+        start = perf_counter()
+        function()
+        times.append(perf_counter() - start)
+    return statistics.median(times)
+
+
+def peak_memory(function):
+    # The most memory function had allocated at once, in bytes
+    gc.collect()
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def load(path):
+    pcfg = PCFG()
+    pcfg.load(path)
+    return pcfg
+
+
+def bench_grammar(metrics, grammar_file, repeat):
+    metrics["grammar.load_s"] = median_time(lambda: load(grammar_file), repeat)
+    metrics["grammar.load_peak_bytes"] = peak_memory(lambda: load(grammar_file))
+    with tempfile.TemporaryDirectory() as tmp:
+        compiled = os.path.join(tmp, "grammar.bin")
+        load(grammar_file).save_compiled(compiled)
+        metrics["grammar.load_compiled_s"] = median_time(lambda: load(compiled), repeat)
+        metrics["grammar.load_compiled_peak_bytes"] = peak_memory(lambda: load(compiled))
+
+
+def bench_tokenizers(metrics, lines, repeat, passes=20):
+    tokens = sum(len(words) for words in PennTreebankTokenizer().tokenize_batch(lines)) * passes
+    for name, tokenizer in (("reference", PennTreebankTokenizer()),
+                            ("compiled", CompiledPennTreebankTokenizer())):
+        seconds = median_time(lambda: [tokenizer.tokenize_batch(lines) for _ in range(passes)], repeat)
+        metrics["tokenize.%s.tokens_per_s" % name] = tokens / seconds
+
+
+def parse_timed(parse, sentence):
+    # The tree of a sentence, or None if it has no parse, and the time it took
+    start = perf_counter()
+    try:
+        tree = parse(sentence)
+    except ParseError:
+        tree = None
+    seconds = perf_counter() - start
+    # Earley gives [''] when no parse covers the sentence
+    return (None if tree == [''] else tree), seconds
+
+
+def parse_all(parser, algo, pairs):
+    # The time of every sentence and the F1 and failures over all of them
+    parse = getattr(parser, "parse_" + algo)
+    evaluator = ParseEvaluator()
+    seconds, failures = [], 0
+    for sentence, gold in pairs:
+        tree, s = parse_timed(parse, sentence)
+        seconds.append(s)
+        if tree is None:
+            failures += 1
+        else:
+            evaluator.add(gold, tree)
+    return seconds, evaluator.total_score.fscore(), failures
+
+
+def bench_parsers(metrics, parser, pairs, repeat, prefix="parse", bucket=10):
+    lengths = [len(parser.tokenizer.tokenize(sentence)) for sentence, _ in pairs]
+    longest = pairs[lengths.index(max(lengths))]
+    for algo in ALGOS:
+        runs = []
+        for _ in range(repeat):
+            gc.collect()
+            seconds, f1, failures = parse_all(parser, algo, pairs)
+            runs.append(seconds)
+        # The median time of every sentence, then grouped by length
+        seconds = [statistics.median(times) for times in zip(*runs)]
+        by_length = defaultdict(list)
+        for n, s in zip(lengths, seconds):
+            by_length[n // bucket].append(s)
+        for b, times in sorted(by_length.items()):
+            name = "%s.%s.%d-%d" % (prefix, algo, b * bucket, (b + 1) * bucket - 1)
+            metrics[name + ".median_s"] = statistics.median(times)
+            metrics[name + ".max_s"] = max(times)
+        metrics["%s.%s.total_s" % (prefix, algo)] = sum(seconds)
+        metrics["%s.%s.peak_bytes" % (prefix, algo)] = peak_memory(
+            lambda: parse_all(parser, algo, [longest]))
+        metrics["%s.%s.f1" % (prefix, algo)] = round(f1, 6)
+        metrics["%s.%s.failures" % (prefix, algo)] = failures
+
+
+def bench_evaluator(metrics, gold_trees, repeat):
+    seconds = median_time(lambda: ParseEvaluator().compute_fscore(gold_trees, gold_trees), repeat)
+    metrics["eval.trees_per_s"] = len(gold_trees) / seconds
+
+
+# The hand-picked cases of the tokenizer report
+TOKENIZER_CASES = [
+    '"Hello," he said (quietly)... "Bye."',
+    "They'll save and invest more.",
+    "I cannot go -- wanna 'tis gonna 'twas",
+    "He's here; it costs $5 & more?!",
+    "A & B, #1 is the 1990 's best [sic] {x} <y>.",
+    "Don't WON'T she'd I'M we're they've",
+    "Good muffins cost $3.88\nin New York.  Please buy me\ntwo of them.\nThanks.",
+    "``quoted'' and 'single' quotes.'\"",
+    "3:30, 1,000 and a:b,c.",
+]
+# Characters that some substitution looks at, plus a few letters of the contractions
+TOKENIZER_ALPHABET = ' \t\n"\'`.,:;@#$%&?!()[]{}<>-0123456789sSmMdDlLrReEvVnNtTaAgiowh'
+
+
+def tokens_or_error(tokenizer, line):
+    # The tokens of line, or the error the tokenizer raised
+    try:
+        return tokenizer.tokenize(line)
+    except Exception as error:
+        return type(error)
+
+
+def report_tokenizer(args):
+    reference, compiled = PennTreebankTokenizer(), CompiledPennTreebankTokenizer()
+    lines = open(args.sentences).readlines()
+    rng = random.Random(0)
+    fuzz = [''.join(rng.choice(TOKENIZER_ALPHABET) for _ in range(rng.randint(1, 30)))
+            for _ in range(200000)]
+    mismatches = 0
+    for name, corpus in (("cases", TOKENIZER_CASES), ("fuzz", fuzz), (args.sentences, lines)):
+        wrong = 0
+        for line in corpus:
+            expected, got = tokens_or_error(reference, line), tokens_or_error(compiled, line)
+            if expected != got:
+                wrong += 1
+                if wrong <= 5:
+                    print("  %r\n    expected %r\n    got      %r" % (line, expected, got))
+        print("%-28s %7d lines %7d mismatches" % (name, len(corpus), wrong))
+        mismatches += wrong
+    before, after = (median_time(lambda: tokenizer.tokenize_batch(lines), args.repeat) / len(lines) * 1e6
+                     for tokenizer in (reference, compiled))
+    print("%-28s %7.1f us/line -> %5.1f us/line (%.1fx)" % (args.sentences, before, after, before / after))
+    if mismatches:
+        return "the tokenizers disagree on %d lines" % mismatches
+
+
+def report_lexicon(args):
+    pcfg = load(args.grammar)
+    tokenizer = PennTreebankTokenizer()
+    sentences = [tokenizer.tokenize(line) for line in open(args.sentences)]
+    tokens = sum(len(s) for s in sentences)
+    known = list(pcfg.well_known_words)
+    known_set, lexicon = set(known), Lexicon(known, pcfg.compiled)
+    set_size = peak_memory(lambda: set(known))
+    lexicon_size = peak_memory(lambda: Lexicon(known, pcfg.compiled))
+    print("known words: %d" % len(known))
+    print("%-28s %10s %12s" % ("lookup", "memory", "ns/token"))
+    # The list is only timed once: it scans every known word for every token
+    for name, size, repeat, normalize in (
+            # What load_model used to leave behind: a list scanned for every word
+            ("list (before the fix)", None, 1, lambda s: [w if w in known else Lexicon.RARE for w in s]),
+            ("set", set_size, args.repeat, lambda s: [w if w in known_set else Lexicon.RARE for w in s]),
+            ("Lexicon.word_id", lexicon_size, args.repeat, lambda s: [lexicon.word_id(w) for w in s]),
+            ("Lexicon.normalize", lexicon_size, args.repeat, lexicon.normalize),
+            ("Lexicon.normalize_many", lexicon_size, args.repeat, lexicon.normalize_many)):
+        seconds = median_time(lambda: [normalize(s) for s in sentences], repeat, least=0)
+        memory = "%.0fK" % (size / 1024) if size else "-"
+        print("%-28s %10s %12.0f" % (name, memory, seconds / tokens * 1e9))
+
+
+def report_sentences(parser, args, max_words):
+    # The sentences of at most max_words tokens, or of --max-words
+    max_words = args.max_words or max_words
+    sentences = [line for line in open(args.sentences)
+                 if len(parser.tokenizer.tokenize(line)) <= max_words]
+    print("%d sentences of at most %s words" % (len(sentences), max_words))
+    return sentences
+
+
+def report_span_cache(args):
+    parser = Parser(load(args.grammar))
+    sentences = report_sentences(parser, args, 12)
+
+    def parse_all_CKY():
+        start = perf_counter()
+        trees = [parse_timed(parser.parse_CKY, sentence)[0] for sentence in sentences]
+        return trees, perf_counter() - start
+
+    expected, seconds = parse_all_CKY()
+    print("%-20s %8.2fs" % ("no cache", seconds))
+    parser.span_cache = SpanCache()
+    for run in ("cold cache", "warm cache"):
+        trees, cached_seconds = parse_all_CKY()
+        print("%-20s %8.2fs  %.1fx  %s" % (run, cached_seconds, seconds / cached_seconds, parser.span_cache))
+        if trees != expected:
+            return "the span cache changed the trees"
+
+
+def report_astar(args):
+    pcfg = load(args.grammar)
+    if pcfg.compiled.has_unary_rules:
+        return "A* leaves grammars with unary rules to CKY"
+    parser = Parser(pcfg)
+    # Totals by sentence length: sentences, CKY seconds, A* seconds, pushed, popped, finished
+    totals = defaultdict(lambda: [0, 0.0, 0.0, 0, 0, 0])
+    mismatches = 0
+    for sentence in report_sentences(parser, args, 15):
+        expected, cky_seconds = parse_timed(parser.parse_CKY, sentence)
+        tree, astar_seconds = parse_timed(parser.parse_AStar, sentence)
+        mismatches += tree != expected
+        row = totals[len(parser.tokenizer.tokenize(sentence))]
+        row[0] += 1
+        row[1] += cky_seconds
+        row[2] += astar_seconds
+        row[3] += parser.stats.pushed
+        row[4] += parser.stats.popped
+        row[5] += parser.stats.finished
+
+    print("%6s %9s %9s %9s %7s %10s %10s %10s" % (
+        "words", "sentences", "CKY s", "A* s", "speedup", "pushed", "popped", "finished"))
+    for n in sorted(totals) + ["all"]:
+        row = totals[n] if n != "all" else [sum(column) for column in zip(*totals.values())]
+        print("%6s %9d %9.2f %9.2f %6.1fx %10d %10d %10d" % (
+            n, row[0], row[1], row[2], row[1] / row[2] if row[2] else 0.0, row[3], row[4], row[5]))
+    if mismatches:
+        return "A* and CKY disagree on %d sentences" % mismatches
+
+
+def report_coarse_to_fine(args, thresholds=(None, 1e-6, 1e-5, 1e-4, 1e-3, 1e-2)):
+    pcfg = load(args.grammar)
+    parser = Parser(pcfg)
+    max_words = args.max_words or 15
+    pairs = [(sentence, json.loads(gold)) for sentence, gold in zip(open(args.sentences), open(args.gold))
+             if len(parser.tokenizer.tokenize(sentence)) <= max_words]
+    print("%d sentences of at most %s words" % (len(pairs), max_words))
+    pcfg.coarse_grammar()
+    print("%10s %9s %9s %10s %8s %8s" % ("threshold", "seconds", "speedup", "pruned", "fallback", "F1"))
+
+    baseline = None
+    for threshold in thresholds:
+        parser.configure(coarse_threshold=threshold)
+        evaluator, stats = ParseEvaluator(), CoarseToFineStats()
+        start = perf_counter()
+        for sentence, gold in pairs:
+            tree, _ = parse_timed(parser.parse_CKY, sentence)
+            if tree is None:
+                continue
+            if threshold is not None:
+                stats.cells += parser.stats.cells
+                stats.kept += parser.stats.kept
+                stats.fallbacks += parser.stats.fallbacks
+            evaluator.add(gold, tree)
+        seconds = perf_counter() - start
+        baseline = baseline or seconds
+        print("%10s %9.2f %8.1fx %9.1f%% %8d %8.4f" % (
+            threshold, seconds, baseline / seconds, 100 * stats.pruned(), stats.fallbacks,
+            evaluator.total_score.fscore()))
+
+
+REPORTS = {
+    "tokenizer": report_tokenizer,
+    "lexicon": report_lexicon,
+    "span_cache": report_span_cache,
+    "astar": report_astar,
+    "coarse_to_fine": report_coarse_to_fine,
+}
+
+
+def digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()[:12]
+
+
+def run(args):
+    raw = open(args.sentences).readlines()
+    gold = [json.loads(line) for line in open(args.gold)]
+    metrics = {}
+    print("grammar ...", file=sys.stderr)
+    bench_grammar(metrics, args.grammar, args.repeat)
+    print("tokenizers ...", file=sys.stderr)
+    bench_tokenizers(metrics, raw, args.repeat)
+    print("parsers ...", file=sys.stderr)
+    parser = Parser(load(args.grammar))
+    pairs = [(sentence, tree) for sentence, tree in zip(raw, gold)
+             if len(parser.tokenizer.tokenize(sentence)) <= args.max_words]
+    bench_parsers(metrics, parser, pairs, args.repeat)
+    debug = [json.loads(line) for line in open(args.debug_gold)]
+    bench_parsers(metrics, Parser(load(args.debug_grammar)),
+                  [(" ".join(TreeOperations(tree).fringe()), tree) for tree in debug],
+                  args.repeat, prefix="debug")
+    print("evaluator ...", file=sys.stderr)
+    bench_evaluator(metrics, gold, args.repeat)
+
+    files = (args.grammar, args.sentences, args.gold, args.debug_grammar, args.debug_gold)
+    return {
+        "settings": {"max_words": args.max_words, "repeat": args.repeat, "sentences": len(pairs),
+                     "data": {path: digest(path) for path in files}},
+        "environment": {"python": platform.python_version(), "numpy": np.__version__,
+                        "platform": platform.platform(), "cpus": os.cpu_count()},
+        "metrics": metrics,
+    }
+
+
+def compare(results, baseline, tolerance):
+    # Print every measure next to the baseline and return the ones that regressed
+    if results["settings"] != baseline["settings"]:
+        print("warning: the baseline was run with other settings or data:", baseline["settings"],
+              file=sys.stderr)
+    regressions = []
+    print("%-40s %14s %14s %8s" % ("measure", "baseline", "now", "change"))
+    for name, value in results["metrics"].items():
+        if name not in baseline["metrics"]:
+            continue
+        old = baseline["metrics"][name]
+        if name.endswith(HIGHER_IS_BETTER):
+            change = value / old - 1 if old else 0.0
+            # As slow as a time growing by more than the tolerance
+            worse = -change > tolerance / (1 + tolerance)
+        elif name.endswith(LOWER_IS_BETTER):
+            change = value / old - 1 if old else 0.0
+            worse = change > tolerance and not (name.endswith("_s") and value - old < NOISE_S)
+        else:
+            change = None
+            worse = value != old
+        print("%-40s %14.6g %14.6g %8s%s" % (
+            name, old, value, "%+.1f%%" % (100 * change) if change is not None else "changed" if worse else "same",
+            "  REGRESSION" if worse else ""))
+        if worse:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Benchmark the grammar, tokenizers, parsers and evaluator")
+    arg_parser.add_argument("--grammar", default="data/train_grammar.dat")
+    arg_parser.add_argument("--sentences", default="data/dev.raw")
+    arg_parser.add_argument("--gold", default="data/dev_cnf.dat")
+    arg_parser.add_argument("--debug-grammar", default="data/debug_grammar.dat")
+    arg_parser.add_argument("--debug-gold", default="data/debug_cnf.dat")
+    arg_parser.add_argument("--max-words", type=int,
+                            help="the longest sentence parsed (default 20, or that of the report)")
+    arg_parser.add_argument("--repeat", type=int, default=3)
+    arg_parser.add_argument("--quick", action="store_true", help="--max-words 10 --repeat 1")
+    arg_parser.add_argument("--output", help="write the results to this JSON file")
+    arg_parser.add_argument("--baseline", help="compare with the results of an earlier run")
+    arg_parser.add_argument("--tolerance", type=float, default=0.2,
+                            help="how much worse than the baseline a measure may be (default 0.2, 20%%)")
+    arg_parser.add_argument("--report", choices=sorted(REPORTS), help="run this report instead")
+    args = arg_parser.parse_args(argv)
+    if args.quick:
+        args.max_words, args.repeat = 10, 1
+    if args.report:
+        failure = REPORTS[args.report](args)
+        if failure:
+            sys.exit(failure)
+        return
+    args.max_words = args.max_words or 20
+
+    results = run(args)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            sys.exit("%d measures regressed: %s" % (len(regressions), ", ".join(regressions)))
+    else:
+        for name, value in results["metrics"].items():
+            print("%-40s %14.6g" % (name, value))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,12 @@ from json import dumps
 from mylib.pcfg import PCFG
 from mylib.eval import ParseEvaluator, ParseError
 from mylib.parser import Parser
+from mylib.earley import Beam
+from mylib.bulk import WorkerStats, parallel_parse
+from mylib.service import LatencyStats, ParserService, serve
+from mylib.cache import ParseCache, SpanCache
+from mylib.schedule import Budget, LengthStats, parse_scheduled
+from mylib.metrics import ParseProfiler
 
 '''
 Created by Arradi Nur Rizal
@@ -16,10 +22,27 @@ class Prompt(Cmd):
     def preloop(self):
         super(Prompt, self).preloop()
         self.algo = "Earley"
+        self.beam = Beam()
+        self.log_space = False
+        self.threshold = None
+        self.coarse_threshold = None
+        self.grammar_file = "data/train_grammar.dat" # this is default assumption
+        self.parser = None
+        self.latency = LatencyStats()
+        self.service = None
+        self.server = None
+        self.cache = None
+        self.span_cache = None
+        self.profiler = None
 
     prompt = 'cmd>> '
 
     def do_exit(self, inp):
+        self.do_stop_serve(inp)
+        if self.cache is not None:
+            self.cache.close()
+        if self.profiler is not None:
+            self.profiler.close()
         print("Bye")
         return True
 
@@ -28,71 +51,172 @@ class Prompt(Cmd):
 
     def do_extract_grammar(self, inp):
         i = inp.split()
+        workers = 1
+        if "--workers" in i:
+            w = i.index("--workers")
+            workers = int(i[w + 1])
+            del i[w:w + 2]
+        cache_dir = None
+        if "--cache" in i:
+            c = i.index("--cache")
+            cache_dir = i[c + 1]
+            del i[c:c + 2]
         treebank_file = i[0]
         grammar_file = i[1]
+        compiled = "--compiled" in i[2:]
 
         start = time()
         print("Extracting grammar from " + treebank_file + " ...", file=stderr)
         pcfg = PCFG()
-        pcfg.learn_from_treebank(treebank_file)
+        pcfg.learn_from_treebank(treebank_file, workers, cache_dir)
         print("Saving grammar to " + grammar_file + " ...", file=stderr)
-        pcfg.save_model(grammar_file)
+        if compiled:
+            pcfg.save_compiled(grammar_file)
+        else:
+            pcfg.save_model(grammar_file)
         print("Time: %.2fs\n" % (time() - start), file=stderr)
 
     def help_extract_grammar(self):
-        print("usage: extract_grammar input-path-to-TREEBANK output-path-to-GRAMMAR")
+        print("usage: extract_grammar input-path-to-TREEBANK output-path-to-GRAMMAR [--compiled] [--workers N] [--cache DIR]")
+        print("    --compiled: save the grammar in the binary format, which loads much faster")
+        print("    --workers N: count the trees with N processes, each reading its own part of the file")
+        print("    --cache DIR: keep the grammar in DIR under the hash of the treebank, so extracting it again")
+        print("        from the same treebank only loads it")
 
     def do_eval(self, inp):
         i = inp.split()
+        workers = 1
+        if "--workers" in i:
+            w = i.index("--workers")
+            workers = int(i[w + 1])
+            del i[w:w + 2]
         key_file = open(i[0])
         prediction_file = open(i[1])
 
-        key_trees = [json.loads(l) for l in key_file]
-        predicted_trees = [json.loads(l) for l in prediction_file]
+        key_trees = (json.loads(l) for l in key_file)
+        predicted_trees = (json.loads(l) for l in prediction_file)
         evaluator = ParseEvaluator()
-        evaluator.compute_fscore(key_trees, predicted_trees)
+        evaluator.compute_fscore(key_trees, predicted_trees, workers)
         evaluator.output()
 
     def help_eval(self):
-        print('''Usage: eval path-to-key_file path-to-output_file \n
-            Evalute the accuracy of a output trees compared to a key file.\n''')
+        print('''Usage: eval path-to-key_file path-to-output_file [--workers N] \n
+            Evalute the accuracy of a output trees compared to a key file.\n
+            --workers N: score the trees with N processes\n''')
 
     def do_bulk_parse(self, inp):
         i = inp.split()
+        workers = 1
+        if "--workers" in i:
+            w = i.index("--workers")
+            workers = int(i[w + 1])
+            del i[w:w + 2]
+        cache = self.cache
+        if "--cache" in i:
+            c = i.index("--cache")
+            cache = ParseCache(path=i[c + 1])
+            del i[c:c + 2]
+        budget = None
+        for flag in ("--timeout", "--max-cells"):
+            if flag in i:
+                f = i.index(flag)
+                budget = budget or Budget()
+                if flag == "--timeout":
+                    budget.seconds = float(i[f + 1])
+                else:
+                    budget.cells = int(i[f + 1])
+                del i[f:f + 2]
+        profiler = self.profiler
+        if "--profile" in i or "--pstats" in i:
+            files = []
+            for flag in ("--profile", "--pstats"):
+                f = i.index(flag) if flag in i else None
+                files.append(i[f + 1] if f is not None else None)
+                if f is not None:
+                    del i[f:f + 2]
+            profiler = ParseProfiler(*files)
         start = time()
         grammar_file = i[0]
         print("Loading grammar from " + grammar_file + " ...", file=stderr)    
         pcfg = PCFG()
-        pcfg.load_model(grammar_file)
+        pcfg.load(grammar_file)
         parser = Parser(pcfg)
+        parser.configure(beam=self.beam, log_space=self.log_space, threshold=self.threshold,
+                         coarse_threshold=self.coarse_threshold)
+        parser.cache = cache
+        parser.span_cache = self.span_cache
+        if workers == 1:
+            # Forked workers would share the metrics file
+            parser.profiler = profiler
 
         print("Parsing sentences ...", file=stderr)
+        p_start = time()
+        stats = WorkerStats()
+        costs = LengthStats()
+        if budget is not None:
+            print("Budget per sentence:", budget, file=stderr)
         with open(i[2], "w") as tree_output:
             error_counter = 0
+            parsed = 0
             with open(i[1]) as input_sentences:
-                for idx, sentence in enumerate(input_sentences):
-                    try:
-                        if self.algo == "CKY":
-                            print("Parsing with CKY algorithm at line no.", idx + 1)
-                            s_start = time()
-                            tree = parser.parse_CKY(sentence)
-                            print("Sucess parsing with CKY algorithm at line no.", idx + 1, "Time: (%.2f)s\n" % (time() - s_start), file=stderr)
+                if workers > 1:
+                    print("Parsing with", self.algo, "algorithm in", workers, "workers", file=stderr)
+                    # Hand out the longest sentences of every window first
+                    results = parallel_parse(parser, self.algo, input_sentences, workers,
+                                             grammar_file=grammar_file, stats=stats,
+                                             budget=budget, costs=costs, window=64 * workers)
+                    for idx, tree, failed in results:
+                        if failed:
+                            print('Problems at line no.', idx + 1)
+                            error_counter += 1
+                        parsed += 1
+                        tree_output.write(dumps(tree)+"\n")
+                else:
+                    for idx, sentence in enumerate(input_sentences):
+                        print("Parsing with", self.algo, "algorithm at line no.", idx + 1)
+                        tree, failed, cost = parse_scheduled(parser, self.algo, sentence, budget)
+                        costs.add(*cost)
+                        if failed:
+                            print('Problems at line no.', idx + 1)
+                            error_counter += 1
+                        elif cost[2] != self.algo:
+                            print("Over budget at line no.", idx + 1, "parsed with", cost[2], "Time: (%.2f)s\n" % cost[1], file=stderr)
                         else:
-                            print("Parsing with Earley algorithm at line no.", idx + 1)
-                            s_start = time()
-                            tree = parser.parse_Earley(sentence)
-                            print("Sucess parsing with Earley algorithm at line no.", idx + 1,  "Time: (%.2f)s\n" % (time() - s_start), file=stderr)
-                    except ParseError:
-                        print('Problems at line no.', idx + 1)
-                        tree = ['']
-                        error_counter += 1
-                    tree_output.write(dumps(tree)+"\n")
+                            print("Sucess parsing with", self.algo, "algorithm at line no.", idx + 1, "Time: (%.2f)s\n" % cost[1], file=stderr)
+                        if parser.stats is not None:
+                            print(parser.stats, file=stderr)
+                        parsed += 1
+                        tree_output.write(dumps(tree)+"\n")
 
+        p_time = time() - p_start
         print("Time: (%.2f)s\n" % (time() - start), file=stderr)
+        print("Throughput: %.2f sentences/s" % (parsed / p_time if p_time else 0.0), file=stderr)
+        if workers > 1:
+            stats.output(file=stderr)
+        costs.output(self.algo, file=stderr)
+        if parser.profiler is not None:
+            print("Profile:", parser.profiler, file=stderr)
+            if parser.profiler is not self.profiler:
+                parser.profiler.close()
+        if cache is not None:
+            if workers == 1:
+                # Workers keep their own counters
+                print("Cache:", cache, file=stderr)
+            if cache is not self.cache:
+                cache.close()
         print('Failed parsings:', error_counter)
 
     def help_bulk_parse(self):
-        print("usage: bulk_parse path-to-GRAMMAR-file path-to-input-sentence path-to-output")
+        print("usage: bulk_parse path-to-GRAMMAR-file path-to-input-sentence path-to-output [--workers N] [--cache FILE]")
+        print("    [--timeout SECONDS] [--max-cells CELLS] [--profile METRICS] [--pstats FILE]")
+        print("    the grammar can be saved by extract_grammar as JSON or with --compiled")
+        print("    --workers N: parse with N processes sharing the loaded grammar")
+        print("    --cache FILE: keep the parses in a SQLite file, so the next runs skip the sentences already parsed")
+        print("    --timeout SECONDS: parse the sentences that take longer with CKY and a narrow beam (in log space,")
+        print("        threshold -8), then with a right-branching tree over the best tags")
+        print("    --max-cells CELLS: leave the sentences whose chart has more spans than that to the same fallbacks")
+        print("    --profile METRICS: write the phase times and algorithm counters of every sentence to METRICS as JSON lines")
+        print("    --pstats FILE: dump a cProfile of the parses to FILE; both are only done with one worker")
 
     def do_use_CKY(self, inp):
         self.algo = "CKY"
@@ -102,6 +226,23 @@ class Prompt(Cmd):
     def help_use_CKY(self):
         print("usage: use_CKY; this will switch the parse algorithm to CKY")
 
+    def do_use_NumpyCKY(self, inp):
+        self.algo = "NumpyCKY"
+        print("Parsing algoritm is set to ", self.algo)
+        self.prompt = 'cmd:' + self.algo + '>>'
+
+    def help_use_NumpyCKY(self):
+        print("usage: use_NumpyCKY; this will switch the parse algorithm to the vectorized CKY")
+
+    def do_use_AStar(self, inp):
+        self.algo = "AStar"
+        print("Parsing algoritm is set to ", self.algo)
+        self.prompt = 'cmd:' + self.algo + '>>'
+
+    def help_use_AStar(self):
+        print("usage: use_AStar; this will switch the parse algorithm to A*, which finds the CKY tree best-first")
+        print("    with a grammar that has unary rules between symbols, CKY parses instead")
+
     def do_use_Earley(self, inp):
         self.algo = "Earley"
         print("Parsing algoritm is set to ", self.algo)
@@ -110,26 +251,208 @@ class Prompt(Cmd):
     def help_use_Earley(self):
         print("usage: use_Earley; this will switch the parse algorithm to Earley")
 
+    def do_set_beam(self, inp):
+        i = inp.split()
+        if not i:
+            print("Beam:", self.beam)
+            return
+        width = None if i[0] == "none" else int(i[0])
+        threshold = float(i[1]) if len(i) > 1 else 0.0
+        max_states = int(i[2]) if len(i) > 2 else None
+        self.beam = Beam(width, threshold, max_states)
+        print("Beam:", self.beam)
+
+    def help_set_beam(self):
+        print("usage: set_beam WIDTH [THRESHOLD [MAX_STATES]]; set the pruning of the Earley algorithm")
+        print("    WIDTH: how many of the most probable rules are predicted, or none for all (default 15)")
+        print("    THRESHOLD: drop states less probable than THRESHOLD times the best of their column (default 0)")
+        print("    MAX_STATES: the most states a chart column can hold (default no limit)")
+        print("    without arguments, show the current beam")
+
+    def do_use_log_space(self, inp):
+        i = inp.split()
+        self.log_space = not i or i[0] != "off"
+        self.threshold = float(i[1]) if self.log_space and len(i) > 1 else None
+        print("Log-space scoring:", "on" if self.log_space else "off",
+              "" if self.threshold is None else "threshold %g" % self.threshold)
+
+    def help_use_log_space(self):
+        print("usage: use_log_space [on|off] [THRESHOLD]; score with log-probabilities so long sentences do not underflow")
+        print("    THRESHOLD: with CKY, drop the constituents of a span whose log score is below its best plus THRESHOLD (e.g. -15)")
+
+    def do_use_coarse_to_fine(self, inp):
+        i = inp.split()
+        self.coarse_threshold = None if i and i[0] == "off" else float(i[0]) if i else 1e-3
+        print("Coarse-to-fine CKY:", "off" if self.coarse_threshold is None else
+              "threshold %g" % self.coarse_threshold)
+
+    def help_use_coarse_to_fine(self):
+        print("usage: use_coarse_to_fine [off | THRESHOLD]; with CKY, only build the cells that a parse with")
+        print("    the X|... symbols projected onto X finds likely enough")
+        print("    THRESHOLD: the smallest coarse posterior of a symbol over a span (default 1e-3)")
+
+    def do_use_cache(self, inp):
+        i = inp.split()
+        if i and i[0] == "off":
+            if self.cache is not None:
+                self.cache.close()
+            self.cache = None
+        elif i or self.cache is None:
+            if self.cache is not None:
+                self.cache.close()
+            entries = int(i[0]) if i else 10000
+            max_bytes = int(float(i[1]) * 2**20) if len(i) > 1 else None
+            self.cache = ParseCache(entries, max_bytes, i[2] if len(i) > 2 else None)
+        if self.parser is not None:
+            self.parser.cache = self.cache
+        print("Parse cache:", "off" if self.cache is None else self.cache)
+
+    def help_use_cache(self):
+        print("usage: use_cache [off | ENTRIES [MEGABYTES [FILE]]]; reuse the trees of sentences already parsed")
+        print("    ENTRIES: the most trees kept in memory (default 10000)")
+        print("    MEGABYTES: the most memory the trees can take (default no limit)")
+        print("    FILE: also keep the trees in this SQLite file, for the next sessions and bulk_parse")
+        print("    without arguments, turn the cache on or show its counters")
+
+    def do_use_span_cache(self, inp):
+        i = inp.split()
+        if i and i[0] == "off":
+            self.span_cache = None
+        elif i or self.span_cache is None:
+            self.span_cache = SpanCache(int(i[0]) if i else 100000)
+        if self.parser is not None:
+            self.parser.span_cache = self.span_cache
+        print("Span cache:", "off" if self.span_cache is None else self.span_cache)
+
+    def help_use_span_cache(self):
+        print("usage: use_span_cache [off | ENTRIES]; with CKY, reuse the chart cells of word sequences already parsed")
+        print("    ENTRIES: the most cells kept (default 100000)")
+        print("    without arguments, turn the cache on or show its counters")
+
+    def warm_parser(self):
+        # Load the grammar the first time only and keep the parser for the next sentences
+        if self.parser is None:
+            print("Loading grammar from " + self.grammar_file + " ...", file=stderr)
+            pcfg = PCFG()
+            pcfg.load(self.grammar_file)
+            self.parser = Parser(pcfg)
+        self.parser.configure(beam=self.beam, log_space=self.log_space, threshold=self.threshold,
+                         coarse_threshold=self.coarse_threshold)
+        self.parser.cache = self.cache
+        self.parser.span_cache = self.span_cache
+        self.parser.profiler = self.profiler
+        return self.parser
+
+    def do_load_grammar(self, inp):
+        start = time()
+        self.grammar_file = inp.strip() or self.grammar_file
+        self.parser = None
+        self.warm_parser()
+        print("Time: (%.2f)s\n" % (time() - start), file=stderr)
+
+    def help_load_grammar(self):
+        print("usage: load_grammar path-to-GRAMMAR; the grammar used to parse the sentences typed at the prompt")
+        print("    (default: data/train_grammar.dat, loaded once on the first sentence)")
+
+    def do_serve(self, inp):
+        i = inp.split()
+        workers = 1
+        if "--workers" in i:
+            w = i.index("--workers")
+            workers = int(i[w + 1])
+            del i[w:w + 2]
+        port = int(i[0]) if i else 8080
+        self.do_stop_serve("")
+        self.service = ParserService(self.warm_parser(), self.algo, workers)
+        self.server = serve(self.service, port=port)
+        print("Serving", self.algo, "parses on http://127.0.0.1:%d with %d workers" % (port, workers))
+
+    def help_serve(self):
+        print("usage: serve [PORT] [--workers N]; parse sentences sent over HTTP with the current grammar and algorithm")
+        print('    POST /parse {"sentences": ["...", ...]} returns {"trees": [...], "failed": [...]}')
+        print("    GET /stats returns the latency percentiles")
+
+    def do_stop_serve(self, inp):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.service.close()
+            self.server = self.service = None
+            print("Stopped serving")
+
+    def help_stop_serve(self):
+        print("usage: stop_serve; stop the server started by serve")
+
+    def do_stats(self, inp):
+        self.latency.output("prompt")
+        if self.service is not None:
+            self.service.latency.output("served")
+            print("queued requests:", self.service.requests.qsize())
+        if self.cache is not None:
+            print("parse cache:", self.cache)
+        if self.span_cache is not None:
+            print("span cache:", self.span_cache)
+        if self.profiler is not None:
+            print("profile:", self.profiler)
+
+    def help_stats(self):
+        print("usage: stats; show the latency percentiles of the sentences parsed at the prompt and served,")
+        print("    the counters of the parse and span caches and the profile")
+
+    def do_profile(self, inp):
+        i = inp.split()
+        if not i or i[0] not in ("on", "off"):
+            return self.help_profile()
+        if self.profiler is not None:
+            self.profiler.close()
+            print("Profile:", self.profiler)
+            self.profiler = None
+        if i[0] == "on":
+            self.profiler = ParseProfiler(*i[1:3])
+        if self.parser is not None:
+            self.parser.profiler = self.profiler
+        print("Profiling:", i[0])
+
+    def help_profile(self):
+        print("usage: profile on [METRICS [PSTATS]] | off; time the tokenizer, normalization, parse and backtrace")
+        print("    of every sentence parsed at the prompt or by bulk_parse, and count the work of the algorithm")
+        print("    METRICS: write them to this file as one JSON line per sentence")
+        print("    PSTATS: dump a cProfile of the parses to this file, e.g. for python -m pstats PSTATS")
+        print("    profile off prints the totals, also shown by stats")
+
+    def do_kbest(self, inp):
+        i = inp.split(None, 1)
+        if len(i) < 2 or not i[0].isdigit():
+            return self.help_kbest()
+        start = time()
+        parser = self.warm_parser()
+        try:
+            for tree, prob in parser.parse_kbest(i[1], int(i[0])):
+                print("%.6g" % prob, dumps(tree))
+        except ParseError:
+            print("Problems parsing the sentence")
+        self.latency.add(time() - start)
+        print("Time: (%.2f)s\n" % (time() - start), file=stderr)
+
+    def help_kbest(self):
+        print("usage: kbest K SENTENCE; print the K most probable CKY trees of the sentence, best first,")
+        print("    each after its probability (log-probability with use_log_space)")
+
     def default(self, inp):
         if inp == 'x' or inp == 'q':
             return self.do_exit(inp)
 
         start = time()
-        grammar_file = "data/train_grammar.dat" # this is default assumption
-        print("Loading grammar from " + grammar_file + " ...", file=stderr)
-        pcfg = PCFG()
-        pcfg.load_model(grammar_file)
-        parser = Parser(pcfg)
-
-        test_sentence = 'Pierre Vinken will soon join the board .'
-        print("Parsing sentences ...", file=stderr)
-        if self.algo == "CKY":
-            print("Parsing with CKY algorithm")
-            tree = parser.parse_CKY(test_sentence)
-        else:
-            print("Parsing with Earley algorithm")
-            tree = parser.parse_Earley(test_sentence)
-        print(dumps(tree))
+        parser = self.warm_parser()
+        print("Parsing with", self.algo, "algorithm")
+        try:
+            tree = getattr(parser, "parse_" + self.algo)(inp)
+            print(dumps(tree))
+        except ParseError:
+            print("Problems parsing the sentence")
+        if parser.stats is not None:
+            print(parser.stats, file=stderr)
+        self.latency.add(time() - start)
         print("Time: (%.2f)s\n" % (time() - start), file=stderr)
 
     do_EOF = do_exit
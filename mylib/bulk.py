@@ -0,0 +1,190 @@
+'''
+A module that parses many sentences in parallel worker processes
+'''
+
+import multiprocessing
+import os
+from collections import defaultdict, deque
+from time import time
+
+from mylib.parser import Parser
+from mylib.pcfg import PCFG
+from mylib.schedule import parse_scheduled
+
+# The parser of a worker process, set up once by init_worker
+_parser = None
+_algo = None
+_budget = None
+
+
+def init_worker(source, algo, settings=None, budget=None):
+    '''
+    Set up the parser of a worker process.
+
+    Args:
+        source (Parser or str): The parser of the parent, inherited by a forked
+            worker, or the grammar file to load when workers are spawned.
+        algo (str): The parsing algorithm, e.g. "CKY" or "Earley".
+        settings (dict): The Parser.settings of a parser loaded from a file.
+        budget (Budget): The budget of every sentence, or None for no limit.
+    '''
+    global _parser, _algo, _budget
+    if isinstance(source, str):
+        pcfg = PCFG()
+        pcfg.load(source)
+        source = Parser(pcfg)
+        source.configure(**(settings or {}))
+    _parser, _algo, _budget = source, algo, budget
+
+
+def parse_chunk(chunk):
+    '''
+    Parse a chunk of sentences in a worker.
+
+    Args:
+        chunk (list): The (line index, sentence) pairs to parse.
+
+    Returns:
+        tuple: The worker pid, the time spent, the (line index, tree, failed)
+            triple of every sentence and the (tokens, seconds, strategy) cost
+            of every sentence. A sentence that fails gets the tree [''].
+    '''
+    start = time()
+    results = []
+    costs = []
+    for idx, sentence in chunk:
+        tree, failed, cost = parse_scheduled(_parser, _algo, sentence, _budget)
+        results.append((idx, tree, failed))
+        costs.append(cost)
+    return os.getpid(), time() - start, results, costs
+
+
+def chunks(sentences, size):
+    # Number the sentences and group them in lists of the given size
+    chunk = []
+    for item in enumerate(sentences):
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def length_chunks(sentences, size, window):
+    # Number the sentences, and group those of every window of them by length,
+    # longest first, so the long ones are not left to the end of the window
+    batch = []
+    for item in enumerate(sentences):
+        batch.append(item)
+        if len(batch) == window:
+            yield from _longest_first(batch, size)
+            batch = []
+    yield from _longest_first(batch, size)
+
+
+def _longest_first(batch, size):
+    batch.sort(key=lambda item: len(item[1].split()), reverse=True)
+    for i in range(0, len(batch), size):
+        yield batch[i:i + size]
+
+
+class WorkerStats():
+    '''
+    The sentences, failures and parse time of every worker
+    '''
+    def __init__(self):
+        self.sentences = defaultdict(int)
+        self.failures = defaultdict(int)
+        self.seconds = defaultdict(float)
+
+    def add(self, pid, seconds, results):
+        self.sentences[pid] += len(results)
+        self.failures[pid] += sum(failed for _, _, failed in results)
+        self.seconds[pid] += seconds
+
+    def output(self, file=None):
+        '''
+        Print the throughput and failures of every worker.
+        '''
+        print("%10s  %10s  %10s  %12s" % ("Worker", "Sentences", "Failures", "Sentences/s"), file=file)
+        for pid in sorted(self.sentences):
+            rate = self.sentences[pid] / self.seconds[pid] if self.seconds[pid] else 0.0
+            print("%10d  %10d  %10d  %12.2f" % (pid, self.sentences[pid], self.failures[pid], rate),
+                  file=file)
+
+
+def parallel_parse(parser, algo, sentences, workers, chunk_size=4, grammar_file=None, stats=None,
+                   budget=None, costs=None, window=None):
+    '''
+    Parse sentences with a pool of worker processes, in input order.
+
+    Workers are forked from the parent so they share its grammar copy-on-write.
+    Where fork is not available they load grammar_file instead, which is shared
+    through mmap when it is a compiled grammar. Sentences are read lazily and at
+    most a few chunks per worker are in flight, so memory does not grow with the
+    size of the input.
+
+    With a window, the sentences are read that many at a time and handed out
+    longest first, in chunks of sentences of about the same length, so that the
+    workers finish the window together instead of waiting for the one that got
+    the longest sentences last. The trees are still yielded in input order.
+
+    Args:
+        parser (Parser): The parser with the grammar already loaded.
+        algo (str): The parsing algorithm, e.g. "CKY" or "Earley".
+        sentences (iterable): The sentences to parse.
+        workers (int): The number of worker processes.
+        chunk_size (int): The number of sentences handed out at a time.
+        grammar_file (str): The grammar to load in workers that are not forked.
+        stats (WorkerStats): Collects the statistics of every worker.
+        budget (Budget): The budget of every sentence, or None for no limit.
+        costs (LengthStats): Collects the cost of every sentence by length.
+        window (int): The number of sentences sorted by length at a time, or
+            None to hand them out in input order.
+
+    Yields:
+        tuple: The (line index, tree, failed) triple of every sentence.
+
+    Raises:
+        ValueError: If the workers cannot be forked and there is no grammar_file.
+    '''
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context, source = multiprocessing.get_context('fork'), parser
+    elif grammar_file is None:
+        raise ValueError('Workers that are not forked need the grammar_file to load')
+    else:
+        context, source = multiprocessing.get_context(), grammar_file
+
+    if window is None:
+        batches = chunks(sentences, chunk_size)
+    else:
+        batches = length_chunks(sentences, chunk_size, window)
+    initargs = (source, algo, parser.settings(), budget)
+    with context.Pool(workers, initializer=init_worker, initargs=initargs) as pool:
+        pending = deque()
+        done = {}
+        following = 0
+        for chunk in batches:
+            pending.append(pool.apply_async(parse_chunk, (chunk,)))
+            if len(pending) >= 2 * workers:
+                following = yield from _collect(pending.popleft(), stats, costs, done, following)
+        while pending:
+            following = yield from _collect(pending.popleft(), stats, costs, done, following)
+
+
+def _collect(result, stats, costs, done, following):
+    # Yield the results that follow the ones already yielded, keep the others
+    # in done, and return the index of the next one to yield
+    pid, seconds, results, chunk_costs = result.get()
+    if stats is not None:
+        stats.add(pid, seconds, results)
+    if costs is not None:
+        for cost in chunk_costs:
+            costs.add(*cost)
+    for triple in results:
+        done[triple[0]] = triple
+    while following in done:
+        yield done.pop(following)
+        following += 1
+    return following
@@ -0,0 +1,200 @@
+'''
+A module that caches parse results, in memory with LRU eviction and optionally
+in a SQLite file that outlives the process, and the CKY cells of spans that
+sentences share.
+'''
+
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from json import dumps, loads
+
+
+class ParseCache():
+    '''
+    A ParseCache maps a parse request to the resulting tree, or to a failure.
+
+    Trees are kept as JSON, so every hit returns a fresh copy and the memory
+    held is the size of the JSON text. The least recently used entries are
+    evicted once there are more than max_entries of them or they take more than
+    max_bytes. With a path, every result is also written to a SQLite file, which
+    is read on a miss, so another run over the same corpus skips the sentences
+    already parsed.
+    '''
+    def __init__(self, max_entries=10000, max_bytes=None, path=None):
+        '''
+        Initialize an empty cache.
+
+        Args:
+            max_entries (int): The most results kept in memory.
+            max_bytes (int): The most bytes of trees kept in memory, or None for no limit.
+            path (str): The SQLite file to persist the results to, or None.
+        '''
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.path = path
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.__db = None
+        self.__pid = None
+
+    @staticmethod
+    def key(fingerprint, algo, settings, norm_words):
+        '''
+        Build the key of a parse request.
+
+        Args:
+            fingerprint (str): The fingerprint of the grammar.
+            algo (str): The parsing algorithm, e.g. "CKY" or "Earley".
+            settings (dict): The Parser.settings the tree depends on.
+            norm_words (list): The (norm, word) pairs of the sentence.
+
+        Returns:
+            str: A hex digest of the request.
+        '''
+        settings = sorted((name, str(value)) for name, value in settings.items())
+        request = dumps([fingerprint, algo, settings, norm_words])
+        return hashlib.sha1(request.encode('utf-8')).hexdigest()
+
+    def __connection(self):
+        # The SQLite connection of this process; forked workers open their own
+        if self.__pid != os.getpid():
+            self.__db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self.__db.execute("PRAGMA journal_mode=WAL")
+            self.__db.execute("PRAGMA synchronous=OFF")
+            self.__db.execute("CREATE TABLE IF NOT EXISTS parses (key TEXT PRIMARY KEY, tree TEXT)")
+            self.__pid = os.getpid()
+        return self.__db
+
+    def get(self, key):
+        '''
+        Look up a parse request.
+
+        Returns:
+            tuple: Whether the request was found and its tree, None for a failure.
+        '''
+        with self.lock:
+            tree = self.entries.get(key)
+            if tree is not None:
+                self.entries.move_to_end(key)
+            elif self.path is not None:
+                row = self.__connection().execute(
+                    "SELECT tree FROM parses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    tree = row[0]
+                    self.__keep(key, tree)
+            if tree is None:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+        return True, loads(tree)
+
+    def put(self, key, tree):
+        '''
+        Store the tree of a parse request, or None if it failed.
+        '''
+        tree = dumps(tree)
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.__keep(key, tree)
+            if self.path is not None:
+                db = self.__connection()
+                db.execute("INSERT OR REPLACE INTO parses VALUES (?, ?)", (key, tree))
+                db.commit()
+
+    def __keep(self, key, tree):
+        self.entries[key] = tree
+        self.size += len(tree)
+        while self.entries and (len(self.entries) > self.max_entries or
+                                (self.max_bytes is not None and self.size > self.max_bytes)):
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def clear(self):
+        '''
+        Forget the results kept in memory; the SQLite file is left as it is.
+        '''
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def close(self):
+        if self.__db is not None and self.__pid == os.getpid():
+            self.__db.close()
+        self.__db = self.__pid = None
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        return 'entries: {}, bytes: {}, hits: {}, misses: {}, evictions: {}, hit rate: {:.1%}'.format(
+            len(self.entries), self.size, self.hits, self.misses, self.evictions,
+            self.hits / lookups if lookups else 0.0)
+
+
+class SpanCache():
+    '''
+    A SpanCache keeps the CKY cells of recently parsed spans, keyed by the words
+    of the span.
+
+    The cell of a span only depends on its words, the grammar and the scoring,
+    so sentences sharing a run of words can reuse the cells of every span inside
+    it. A cell maps each symbol to its (score, C1, C2, split) entry, with the
+    split point counted from the start of the span, or to a (score, label, Y,
+    C1, C2, split) entry for a chain of unary rules over the entry of Y.
+    '''
+    def __init__(self, max_entries=100000):
+        '''
+        Initialize an empty cache.
+
+        Args:
+            max_entries (int): The most cells kept.
+        '''
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.scoring = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def bind(self, fingerprint, log_space, threshold):
+        '''
+        Forget the cells when the grammar or the scoring changes.
+        '''
+        scoring = (fingerprint, log_space, threshold)
+        if scoring != self.scoring:
+            self.entries.clear()
+            self.scoring = scoring
+
+    def get(self, words):
+        '''
+        Get the cell of a span, or None.
+
+        Args:
+            words (tuple): The word ids of the span.
+        '''
+        cell = self.entries.get(words)
+        if cell is None:
+            self.misses += 1
+        else:
+            self.entries.move_to_end(words)
+            self.hits += 1
+        return cell
+
+    def put(self, words, cell):
+        self.entries[words] = cell
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        return 'cells: {}, hits: {}, misses: {}, evictions: {}, hit rate: {:.1%}'.format(
+            len(self.entries), self.hits, self.misses, self.evictions,
+            self.hits / lookups if lookups else 0.0)
@@ -0,0 +1,186 @@
+'''
+A module that prunes the chart of the fine grammar with the posteriors of a
+coarse CKY pass, for coarse-to-fine parsing.
+
+The coarse grammar (PCFG.coarse_grammar) has a few hundred symbols instead of
+thousands, so its inside and outside scores are computed over a dense chart
+with NumPy, and the fine CKY only builds the symbols whose coarse symbol is
+likely enough over the span. Unary rules between symbols are applied through
+the best chain of every pair, as in CKY, so the coarse scores of a grammar
+with them are lower bounds of the sums over trees.
+'''
+
+import numpy as np
+
+
+class CoarseToFineStats():
+    '''
+    The cells of the coarse chart kept for the fine pass
+    '''
+    def __init__(self):
+        self.cells = 0
+        self.kept = 0
+        self.fallbacks = 0
+
+    def pruned(self):
+        # The fraction of the possible (span, coarse symbol) cells pruned
+        return 1.0 - self.kept / self.cells if self.cells else 0.0
+
+    def __str__(self):
+        return 'coarse cells: {}, kept: {}, pruned: {:.1%}, fallbacks: {}'.format(
+            self.cells, self.kept, self.pruned(), self.fallbacks)
+
+
+def add_scaled(cells, scales, added, added_scales):
+    # Add the rows of added, each worth added * exp(added_scale), to the rows of
+    # cells, worth cells * exp(scale), in place, rescaling every row to the
+    # larger of the two scales
+    top = added.max(1)
+    scaled = top > 0
+    added = added / np.where(scaled, top, 1.0)[:, None]
+    added_scales = np.where(scaled, added_scales + np.log(np.where(scaled, top, 1.0)), -np.inf)
+    new = np.maximum(scales, added_scales)
+    live = np.isfinite(new)
+    if not live.any():
+        return
+    cells[live] = cells[live] * np.exp(scales[live] - new[live])[:, None] + \
+        added[live] * np.exp(added_scales[live] - new[live])[:, None]
+    scales[live] = new[live]
+
+
+def unary_matrix(grammar):
+    # The probability of the best chain of unary rules from X down to Y, at [Y, X]
+    N = len(grammar)
+    chains = np.zeros((N, N))
+    children = np.repeat(np.arange(N), np.diff(grammar.closure_offsets))
+    chains[children, grammar.closure_parent] = grammar.closure_prob
+    return chains
+
+
+def inside_outside(grammar, norm_words):
+    '''
+    Compute the inside and outside scores of every symbol over every span.
+
+    Scores are sums over trees, with any symbol allowed over the whole sentence
+    as CKY does. The scores of a long sentence are far below the smallest float,
+    so the scores of every span are kept as a chart row scaled to at most about
+    1 and the log of its scale: the score of C over [Min, Max] is
+    chart[Min, Max, C] * exp(scale[Min, Max]), and a span without scores has a
+    scale of -inf.
+
+    With unary rules, the inside chart has the scores of the symbols with the
+    chains over them, and the base chart, with the same scales, those without:
+    a chain builds X over a span from the base score of Y. The outside chart
+    has the outside scores of the symbols with their chains.
+
+    Args:
+        grammar (CompiledGrammar): The (coarse) grammar.
+        norm_words (list): The (norm, word) pairs of the sentence.
+
+    Returns:
+        tuple: The inside, base and outside charts, indexed by [Min, Max, symbol]
+            from 0, the scales of the inside and outside charts, indexed by
+            [Min, Max], the chains of unary_matrix or None without unary rules,
+            and the log of the total score of the sentence (-inf if it has no
+            parse).
+    '''
+    n, N = len(norm_words), len(grammar)
+    parent, left, right, q = grammar.rule_parent, grammar.rule_left, grammar.rule_right, grammar.rule_prob
+    chains = unary_matrix(grammar) if grammar.has_unary_rules else None
+    inside = np.zeros((n, n, N))
+    base = np.zeros((n, n, N)) if chains is not None else inside
+    inside_scale = np.full((n, n), -np.inf)
+
+    def close(Min, Max, cell, scale):
+        # Store the scores of a cell, with the chains over them
+        closed = cell + cell @ chains if chains is not None else cell
+        top = closed.max()
+        if top > 0:
+            inside[Min, Max] = closed / top
+            if chains is not None:
+                base[Min, Max] = cell / top
+            inside_scale[Min, Max] = scale + np.log(top)
+
+    for Min in range(n):
+        symbols, probs = grammar.preterminals(grammar.word_id(norm_words[Min][0]))
+        cell = np.zeros(N)
+        cell[symbols] = probs
+        close(Min, Min, cell, 0.0)
+
+    for l in range(1, n):
+        for Min in range(n - l):
+            Max = Min + l
+            lefts, rights = inside[Min, Min:Max], inside[Min + 1:Max + 1, Max]
+            rules = np.flatnonzero((lefts > 0).any(0)[left] & (rights > 0).any(0)[right])
+            if not len(rules):
+                continue
+            # Every split scaled to the largest one
+            splits = inside_scale[Min, Min:Max] + inside_scale[Min + 1:Max + 1, Max]
+            scale = splits.max()
+            if not np.isfinite(scale):
+                continue
+            weights = np.exp(splits - scale)[:, None]
+            scores = q[rules] * (lefts[:, left[rules]] * rights[:, right[rules]] * weights).sum(0)
+            close(Min, Max, np.bincount(parent[rules], scores, N), scale)
+
+    outside = np.zeros((n, n, N))
+    outside_scale = np.full((n, n), -np.inf)
+    outside[0, n - 1] = 1.0
+    outside_scale[0, n - 1] = 0.0
+    for l in range(n - 1, 0, -1):
+        for Min in range(n - l):
+            Max = Min + l
+            out = outside[Min, Max]
+            if chains is not None:
+                # The outside scores of the symbols under the chains
+                out = out + chains @ out
+            lefts, rights = inside[Min, Min:Max], inside[Min + 1:Max + 1, Max]
+            rules = np.flatnonzero((out > 0)[parent] & (lefts > 0).any(0)[left] & (rights > 0).any(0)[right])
+            if not len(rules):
+                continue
+            weights = q[rules] * out[parent[rules]]
+            # Split s puts [Min, Min+s] on the left and [Min+s+1, Max] on the right
+            offsets = np.arange(l)[:, None] * N
+            to_left = np.bincount((offsets + left[rules]).ravel(),
+                                  (weights * rights[:, right[rules]]).ravel(), l * N).reshape(l, N)
+            to_right = np.bincount((offsets + right[rules]).ravel(),
+                                   (weights * lefts[:, left[rules]]).ravel(), l * N).reshape(l, N)
+            add_scaled(outside[Min, Min:Max], outside_scale[Min, Min:Max],
+                       to_left, outside_scale[Min, Max] + inside_scale[Min + 1:Max + 1, Max])
+            add_scaled(outside[Min + 1:Max + 1, Max], outside_scale[Min + 1:Max + 1, Max],
+                       to_right, outside_scale[Min, Max] + inside_scale[Min, Min:Max])
+    total = inside[0, n - 1].sum()
+    log_total = inside_scale[0, n - 1] + np.log(total) if total > 0 else -np.inf
+    return inside, base, outside, inside_scale, outside_scale, chains, log_total
+
+
+def prune_chart(pcfg, norm_words, threshold, stats=None):
+    '''
+    Decide which cells of the fine chart to build from the coarse posteriors.
+
+    Args:
+        pcfg (PCFG): The grammar, whose coarse_grammar is used for the coarse pass.
+        norm_words (list): The (norm, word) pairs of the sentence.
+        threshold (float): The smallest posterior of a coarse symbol over a span
+            for the fine symbols projected onto it to be built.
+        stats (CoarseToFineStats): Counts the cells kept and pruned.
+
+    Returns:
+        ndarray: Whether each fine symbol may be built over each span, indexed by
+            [Min, Max, symbol] from 0, or None if the coarse grammar cannot parse
+            the sentence.
+    '''
+    coarse, projection = pcfg.coarse_grammar()
+    inside, base, outside, inside_scale, outside_scale, chains, log_total = inside_outside(coarse, norm_words)
+    if not np.isfinite(log_total):
+        return None
+    posterior = inside * outside
+    if chains is not None:
+        # A symbol is also built under the chains over it
+        posterior += base * (outside @ chains.T)
+    posterior *= np.exp(inside_scale + outside_scale - log_total)[:, :, None]
+    keep = posterior >= threshold
+    if stats is not None:
+        stats.cells += int(np.count_nonzero(inside > 0))
+        stats.kept += int(np.count_nonzero(keep & (inside > 0)))
+    return keep[:, :, projection]
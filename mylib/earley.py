@@ -2,53 +2,85 @@
 A module that implements the Earley Algorithm
 '''
 
+from math import log
+from time import perf_counter, time
+
 from mylib.pcfg import PCFG
-from mylib.eval import ParseError
+from mylib.eval import ParseError, ParseTimeout
+
+# The id of the ROOT symbol and of the ROOT -> S rule
+ROOT = -1
+# The rule id of the states built by the scanner
+LEXICAL = -2
+# The right-hand side of the states built by the scanner, which only matters for its length
+LEXICAL_RHS = (LEXICAL,)
+# The rule id and right-hand side of the states of a chain of unary rules over
+# a completed state, built by the completer
+UNARY = -3
+UNARY_RHS = (UNARY,)
+# Backpointers pack the chart column and the position in it into one int
+COLUMN_SHIFT = 32
+POSITION_MASK = (1 << COLUMN_SHIFT) - 1
 
 class State():
     '''
     A State is something records the current grammar rule, the dot position and the span
     '''
-    def __init__(self, lhs='', rhs=None, start_idx=0, end_idx=0, dot_idx=0):
+    __slots__ = ('uid', 'lhs', 'rule', 'rhs', 'start_idx', 'end_idx', 'dot_idx',
+                 'backpointers', 'fwd_prob', 'in_prob', 'word')
+
+    def __init__(self, lhs=ROOT, rule=ROOT, rhs=(), start_idx=0, end_idx=0, dot_idx=0):
         '''
         Initialize a state.
 
         Args:
-            lhs (string): The left-hand symbol.
-            rhs (list): The right-hand symbols in a list.
+            lhs (int): The id of the left-hand symbol.
+            rule (int): The id of the binary rule, ROOT, LEXICAL or UNARY.
+            rhs (tuple): The ids of the right-hand symbols, shared by all states of the rule.
             start_idx: The start index of the state in the sentence.
             end_idx: The dot index in the scope of the whole sentence.
             dot_idx: The dot index in the scope of current state.
         '''
         self.uid = 0
         self.lhs = lhs
-        if rhs is None:
-            self.rhs = []
-        else:
-            self.rhs = rhs
+        self.rule = rule
+        self.rhs = rhs
         self.start_idx = start_idx
         self.end_idx = end_idx
         self.dot_idx = dot_idx
-        self.backpointers = []
+        self.backpointers = ()
         self.fwd_prob = 0
         self.in_prob = 0
+        # The word of a LEXICAL state, the label of the collapsed node of a UNARY one
         self.word = ''
 
     def __eq__(self, other):
         if not isinstance(other, State):
             return False
         return self.lhs == other.lhs and \
-            self.rhs == other.rhs and \
+            self.rule == other.rule and \
             self.start_idx == other.start_idx and \
             self.end_idx == other.end_idx and \
             self.dot_idx == other.dot_idx
 
-    def next_cat(self) -> str:
+    def __hash__(self):
+        return hash((self.key(), self.end_idx))
+
+    def key(self) -> tuple:
+        '''
+        Get what identifies the state within a chart column.
+
+        Returns:
+            tuple: The left-hand symbol, the rule id, the start index and the dot index.
+        '''
+        return (self.lhs, self.rule, self.start_idx, self.dot_idx)
+
+    def next_cat(self) -> int:
         '''
         Get the next right-hand symbol from the constituents predicted by this rule.
 
         Returns:
-            string: The next right-hand symbol, or None if it's already completed.
+            int: The id of the next right-hand symbol, or None if it's already completed.
         '''
         if self.is_completed():
             return None
@@ -64,38 +96,140 @@ class State():
         '''
         return self.dot_idx >= len(self.rhs)
 
+class Beam():
+    '''
+    A Beam decides which states the Earley parser keeps
+    '''
+    def __init__(self, width=15, threshold=0.0, max_states=None):
+        '''
+        Initialize a beam. The default keeps the 15 most probable predictions and
+        nothing else is pruned.
+
+        Args:
+            width (int): How many of the most probable rules the predictor expands, or None for all.
+            threshold (float): Drop the states whose forward probability is below this fraction
+                of the best one in their column, or 0 to keep them all.
+            max_states (int): The most states a column can hold, or None for no limit.
+        '''
+        self.width = width
+        self.threshold = threshold
+        self.max_states = max_states
+
+    def __str__(self):
+        return 'width={} threshold={} max_states={}'.format(self.width, self.threshold, self.max_states)
+
+class EarleyStats():
+    '''
+    The number of states handled while parsing a sentence, the calls of the
+    predictor, scanner and completer, and the time of the backtrace
+    '''
+    def __init__(self):
+        self.created = 0
+        self.duplicates = 0
+        self.pruned = 0
+        self.predictor = 0
+        self.scanner = 0
+        self.completer = 0
+        self.backtrace = 0.0
+
+    def __str__(self):
+        return 'states created: {}, duplicates: {}, pruned: {}, predictor/scanner/completer calls: {}/{}/{}'.format(
+            self.created, self.duplicates, self.pruned, self.predictor, self.scanner, self.completer)
+
 class Chart():
     '''
     A Chart keeps tracks of all of the states during parsing
     '''
-    def __init__(self):
+    def __init__(self, start: int, beam: Beam = None, stats: EarleyStats = None,
+                 log_space: bool = False):
         '''
         Initialize a chart. Will always create an initial state (ROOT->.S, [0, 0])
+
+        Args:
+            start (int): The id of the start symbol S.
+            beam (Beam): The pruning policy of the columns.
+            stats (EarleyStats): Counts the states added, merged and pruned.
+            log_space (bool): Whether the probabilities of the states are log-probabilities.
         '''
-        initial_state = State('ROOT', ['S'], 0, 0, 0)
-        initial_state.fwd_prob = 1.0
-        initial_state.in_prob = 1.0
+        initial_state = State(ROOT, ROOT, (start,), 0, 0, 0)
+        initial_state.fwd_prob = 0.0 if log_space else 1.0
+        initial_state.in_prob = 0.0 if log_space else 1.0
+        self.beam = beam if beam is not None else Beam()
+        self.stats = stats if stats is not None else EarleyStats()
+        self.log_space = log_space
+        self.zero = float('-inf') if log_space else 0.0
+        self.__log_threshold = log(self.beam.threshold) if self.beam.threshold > 0 else float('-inf')
         self.__chart = []
+        self.__index = []
+        self.__waiting = []
+        self.__best = []
         self.enqueue(initial_state, 0)
 
-    def enqueue(self, state_to_add: State, idx: int):
+    def enqueue(self, state_to_add: State, idx: int, prune: bool = True) -> bool:
         '''
-        Add a state to the chart
+        Add a state to the chart. If the column already has the same state, keep the
+        more probable of the two (Viterbi): a better duplicate replaces the probabilities
+        and backpointers of the stored state, a worse one is dropped.
 
         Args:
             state_to_add (State): The state to add.
             idx (int): The index to insert at.
+            prune (bool): Whether the beam applies to the state. Scanned states are always
+                kept, and their forward probability is not compared with the others.
+
+        Returns:
+            bool: True if the state was added, False if it was a duplicate or pruned.
         '''
-        states = []
         if idx < len(self.__chart):
-            states = self.__chart[idx]
-            for state in states:
-                if state == state_to_add:
-                    return
+            states, index = self.__chart[idx], self.__index[idx]
         else:
+            states, index = [], {}
             self.__chart.append(states)
-        state_to_add.uid = '{}/{}'.format(idx, len(states))
+            self.__index.append(index)
+            self.__waiting.append({})
+            self.__best.append(self.zero)
+        key = state_to_add.key()
+        state = index.get(key)
+        if state is not None:
+            self.stats.duplicates += 1
+            if state_to_add.in_prob > state.in_prob:
+                state.in_prob = state_to_add.in_prob
+                state.fwd_prob = state_to_add.fwd_prob
+                state.backpointers = state_to_add.backpointers
+                state.word = state_to_add.word
+            return False
+        if prune:
+            beam = self.beam
+            if self.log_space:
+                floor = self.__best[idx] + self.__log_threshold
+            else:
+                floor = self.__best[idx] * beam.threshold
+            if state_to_add.fwd_prob < floor or \
+                    beam.max_states is not None and len(states) >= beam.max_states:
+                self.stats.pruned += 1
+                return False
+            if state_to_add.fwd_prob > self.__best[idx]:
+                self.__best[idx] = state_to_add.fwd_prob
+        self.stats.created += 1
+        state_to_add.uid = (idx << COLUMN_SHIFT) | len(states)
         states.append(state_to_add)
+        index[key] = state_to_add
+        if not state_to_add.is_completed():
+            self.__waiting[idx].setdefault(state_to_add.next_cat(), []).append(state_to_add)
+        return True
+
+    def waiting(self, idx: int, symbol: int) -> list:
+        '''
+        Get the states of a column whose next symbol is the given one.
+
+        Args:
+            idx (int): The index of the column.
+            symbol (int): The id of the symbol.
+
+        Returns:
+            list: The states, in the order they were added to the column.
+        '''
+        return self.__waiting[idx].get(symbol, ())
 
     def __getitem__(self, key):
         return self.__chart[key]
@@ -107,62 +241,218 @@ class Earley():
     '''
     The Earley Parser
     '''
-    def __init__(self, pcfg: PCFG, sentence: str):
+    def __init__(self, pcfg: PCFG, sentence: str, beam: Beam = None, log_space: bool = False):
         '''
         Initialize an Earley parser
 
         Args:
             pcfg (PCFG): The pcfg grammar.
-            sentence (str): The sentence to parser
+            sentence (list): The (norm, word) pairs of the sentence to parse, or an
+                empty list to feed the words one at a time.
+            beam (Beam): The pruning policy, by default the 15 best predictions.
+            log_space (bool): Add log-probabilities instead of multiplying probabilities,
+                so they cannot underflow on long sentences.
         '''
-        self.chart = Chart()
         self.pcfg = pcfg
+        self.grammar = pcfg.compiled
         self.sentence = sentence
+        if 'S' not in self.grammar.symbol_ids:
+            raise ParseError('The grammar has no start symbol S')
+        self.stats = EarleyStats()
+        self.chart = Chart(self.grammar.symbol_ids['S'], beam, self.stats, log_space)
+        self.beam = self.chart.beam
+        self.log_space = log_space
+        if log_space:
+            self.binary_rules, self.lexical = self.grammar.log_binary_by_parent, self.grammar.log_lexical
+        else:
+            self.binary_rules, self.lexical = self.grammar.binary_by_parent, self.grammar.lexical
+        # The chains of unary rules up from each symbol and down from each one
+        self.closure = self.closure_by_parent = None
+        if self.grammar.has_unary_rules:
+            if log_space:
+                self.closure = self.grammar.log_unary_closure
+                self.closure_by_parent = self.grammar.log_unary_closure_by_parent
+            else:
+                self.closure = self.grammar.unary_closure
+                self.closure_by_parent = self.grammar.unary_closure_by_parent
+        # The words fed so far, and the states to scan with the next one
+        self.tokens = []
+        self.__scans = self.__close(0)
 
-    def parse(self):
+    def parse(self, deadline=None):
         '''
         Parse the setence inside.
+
+        Args:
+            deadline (float): The time() past which the parse stops with a
+                ParseTimeout, or None.
         '''
-        for i in range(len(self.sentence) + 1):
-            word = ''
-            inside_i = 0
-            if i < len(self.sentence):
-                norm, word = self.sentence[i]
-            if i >= len(self.chart):
+        for token in self.sentence[len(self.tokens):]:
+            if deadline is not None and time() > deadline:
+                raise ParseTimeout('Out of time parsing sentence: {}'.format(self.sentence))
+            self.feed(token)
+            if len(self.chart) <= len(self.tokens):
                 raise ParseError('Unable to parse sentence: {}'.format(self.sentence))
-            while inside_i < len(self.chart[i]):
-                state = self.chart[i][inside_i]
-                if state.is_completed():
-                    self.completer(state)
-                else:
-                    next_symbol = state.next_cat()
-                    if self.pcfg.unary_rules[next_symbol]:
-                        self.scanner(state, norm, word)
-                    else:
-                        self.predictor(state)
-                inside_i += 1
-
-        last_state = State()
-        for state in self.chart[len(self.sentence)]:
-            if state.is_completed() and \
-                state.lhs == 'ROOT' and \
-                state.in_prob > last_state.in_prob:
-                last_state = state
-
-        if last_state and last_state.backpointers:
-            return self.backtrace(last_state.backpointers[0])
+
+        last_state = self.__complete()
+        if last_state is not None and last_state.backpointers:
+            start = perf_counter()
+            tree = self.backtrace(last_state.backpointers[0])
+            self.stats.backtrace = perf_counter() - start
+            return tree
         return ['']
 
-    def backtrace(self, backpointer: str):
+    def feed(self, token) -> bool:
+        '''
+        Extend the chart with the next word of the sentence, for input that arrives
+        one word at a time.
+
+        Args:
+            token (tuple): The (norm, word) pair of the word, as in the sentence.
+
+        Returns:
+            bool: The prefix_viable() of the sentence read so far.
+        '''
+        i = len(self.tokens)
+        self.tokens.append(token)
+        norm, word = token
+        norm = self.grammar.word_id(norm)
+        self.stats.scanner += len(self.__scans)
+        for symbol in self.__scans:
+            self.scanner(symbol, i, norm, word)
+        self.__scans = self.__close(i + 1) if i + 1 < len(self.chart) else []
+        return self.prefix_viable()
+
+    def prefix_viable(self) -> bool:
+        '''
+        Check whether the words read so far can still start a parse, i.e. whether
+        the last column waits for a preterminal the next word can be scanned as,
+        or has a complete parse. Once this is False no more words can make the
+        sentence parse.
+        '''
+        n = len(self.tokens)
+        if n >= len(self.chart):
+            return False
+        return bool(self.__scans) or \
+            any(state.lhs == ROOT and state.is_completed() for state in self.chart[n])
+
+    def current_best(self):
+        '''
+        Get the best analysis of the words read so far.
+
+        A complete parse is preferred. Otherwise the partial tree is built from the
+        most probable state still waiting for more words, and holds the constituents
+        already found plus the open ones above them, without their missing children.
+
+        Returns:
+            tuple: The tree (None if there is no analysis), its probability (the inside
+                probability of a complete parse, the forward probability of a partial
+                one) and whether it is complete.
+        '''
+        last_state = self.__complete()
+        if last_state is not None and last_state.backpointers:
+            return self.backtrace(last_state.backpointers[0]), last_state.in_prob, True
+        n = len(self.tokens)
+        if n >= len(self.chart):
+            return None, self.chart.zero, False
+        best = None
+        for state in self.chart[n]:
+            if not state.is_completed() and state.dot_idx > 0 and \
+                    (best is None or state.fwd_prob > best.fwd_prob):
+                best = state
+        if best is None:
+            return None, self.chart.zero, False
+        return self.__partial(best), best.fwd_prob, False
+
+    def __complete(self):
+        # The most probable complete ROOT state of the last column, or None
+        n = len(self.tokens)
+        last_state = None
+        if n < len(self.chart):
+            for state in self.chart[n]:
+                if state.is_completed() and state.lhs == ROOT and \
+                        (last_state is None or state.in_prob > last_state.in_prob):
+                    last_state = state
+        return last_state
+
+    def __partial(self, state: State):
+        # Climb from state to ROOT through the states waiting for each left-hand
+        # symbol, taking the most probable one that was added before the child so
+        # left recursion cannot loop
+        tree = None
+        while True:
+            children = [self.backtrace(bp) for bp in state.backpointers]
+            if tree is not None:
+                children.append(tree)
+            if state.lhs == ROOT:
+                return children[0] if children else None
+            tree = [self.grammar.symbols[state.lhs]] + children
+            parent = None
+            for waiting in self.chart.waiting(state.start_idx, state.lhs):
+                if waiting.uid < state.uid and (parent is None or waiting.fwd_prob > parent.fwd_prob):
+                    parent = waiting
+            if parent is None and self.closure is not None:
+                # Predicted under a chain of unary rules, which collapses into the node
+                for symbol, _, label in self.closure[state.lhs]:
+                    for waiting in self.chart.waiting(state.start_idx, symbol):
+                        if waiting.uid < state.uid and (parent is None or waiting.fwd_prob > parent.fwd_prob):
+                            parent, tree[0] = waiting, label
+            state = parent
+
+    def __close(self, i: int) -> list:
+        '''
+        Run the predictor and the completer over a column.
+
+        Returns:
+            list: The preterminals waited for, directly or under a chain of unary
+                rules, in the order they came, to be scanned with the next word.
+        '''
+        is_preterminal = self.grammar.is_preterminal
+        closure_by_parent = self.closure_by_parent
+        column = self.chart[i]
+        scans, scanned, chained = [], set(), set()
+        inside_i = completed = predicted = 0
+        while inside_i < len(column):
+            state = column[inside_i]
+            if state.is_completed():
+                self.completer(state)
+                completed += 1
+            else:
+                next_symbol = state.next_cat()
+                if is_preterminal[next_symbol]:
+                    # The completer advances every state waiting for the preterminal
+                    if next_symbol not in scanned:
+                        scanned.add(next_symbol)
+                        scans.append(next_symbol)
+                else:
+                    self.predictor(state)
+                    predicted += 1
+                    if closure_by_parent is not None and next_symbol not in chained:
+                        chained.add(next_symbol)
+                        for symbol, _ in closure_by_parent[next_symbol]:
+                            if is_preterminal[symbol] and symbol not in scanned:
+                                scanned.add(symbol)
+                                scans.append(symbol)
+            inside_i += 1
+        self.stats.completer += completed
+        self.stats.predictor += predicted
+        return scans
+
+    def backtrace(self, backpointer: int):
         '''
         Backtrace the parsed tree.
         '''
-        state_set, state_idx = backpointer.split('/')
-        state = self.chart[int(state_set)][int(state_idx)]
-        if len(state.rhs) == 1:
-            return [state.lhs, state.word]
+        state = self.chart[backpointer >> COLUMN_SHIFT][backpointer & POSITION_MASK]
+        symbol = self.grammar.symbols[state.lhs]
+        if state.rule == LEXICAL:
+            return [symbol, state.word]
+        elif state.rule == UNARY:
+            # A chain of unary rules, collapsed into one node as in the treebank
+            tree = self.backtrace(state.backpointers[0])
+            tree[0] = state.word
+            return tree
         else:
-            result = [state.lhs]
+            result = [symbol]
             for bp in state.backpointers:
                 result.append(self.backtrace(bp))
             return result
@@ -176,57 +466,95 @@ class Earley():
         '''
         next_symbol = state.next_cat()
         j = state.end_idx
-        states_to_add = []
-        for rhs in self.pcfg.binary_rules[next_symbol]:
-            candidate = State(next_symbol, list(rhs), j, j, 0)
-            rule_prob = self.pcfg.q2[(next_symbol, *rhs)]
-            candidate.fwd_prob = state.fwd_prob * rule_prob
+        rule_rhs = self.grammar.rule_rhs
+        # The rules are sorted by probability, so the first ones are the most likely candidates
+        rules = self.binary_rules[next_symbol]
+        if self.beam.width is not None and len(rules) > self.beam.width:
+            self.stats.pruned += len(rules) - self.beam.width
+            rules = rules[:self.beam.width]
+        for rule, rule_prob in rules:
+            candidate = State(next_symbol, rule, rule_rhs[rule], j, j, 0)
+            if self.log_space:
+                candidate.fwd_prob = state.fwd_prob + rule_prob
+            else:
+                candidate.fwd_prob = state.fwd_prob * rule_prob
             candidate.in_prob = rule_prob
-            states_to_add.append(candidate)
-
-        states_to_add.sort(key=lambda x: x.fwd_prob, reverse=True)
-        # Prune the tree to the top 10 list
-        for candidate in states_to_add[:15]:
             self.chart.enqueue(candidate, j)
+        if self.closure_by_parent is None:
+            return
+        # The rules of the symbols under a chain of unary rules from next_symbol,
+        # which the completer puts back under the chain
+        for symbol, chain_prob in self.closure_by_parent[next_symbol]:
+            rules = self.binary_rules[symbol]
+            if self.beam.width is not None and len(rules) > self.beam.width:
+                self.stats.pruned += len(rules) - self.beam.width
+                rules = rules[:self.beam.width]
+            for rule, rule_prob in rules:
+                candidate = State(symbol, rule, rule_rhs[rule], j, j, 0)
+                if self.log_space:
+                    candidate.fwd_prob = state.fwd_prob + chain_prob + rule_prob
+                else:
+                    candidate.fwd_prob = state.fwd_prob * chain_prob * rule_prob
+                candidate.in_prob = rule_prob
+                self.chart.enqueue(candidate, j)
 
-    def scanner(self, state: State, norm: str, word: str):
+    def scanner(self, next_symbol: int, j: int, norm: int, word: str):
         '''
         The scanner
 
         Args:
-            state (State): The state to be scanned.
-            norm (str): The normalized form of the word. It can be the word itself, or "_RARE_".
+            next_symbol (int): The id of the preterminal to be scanned.
+            j (int): The index of the word in the sentence.
+            norm (int): The id of the normalized form of the word (the word itself, or "_RARE_"),
+                or -1 if no preterminal produces it.
             word (str): The word to be scanned.
         '''
-        next_symbol = state.next_cat()
-        if self.pcfg.q1[next_symbol, norm] > 0:
-            j = state.end_idx
-            state_to_add = State(next_symbol, [norm], j, j + 1, 1)
+        rule_prob = self.lexical[norm].get(next_symbol) if norm >= 0 else None
+        if rule_prob is not None and rule_prob > self.chart.zero:
+            state_to_add = State(next_symbol, LEXICAL, LEXICAL_RHS, j, j + 1, 1)
             state_to_add.word = word
-            rule_prob = self.pcfg.q1[next_symbol, norm]
             state_to_add.fwd_prob = rule_prob
             state_to_add.in_prob = rule_prob
-            self.chart.enqueue(state_to_add, j + 1)
+            self.chart.enqueue(state_to_add, j + 1, prune=False)
 
     def completer(self, state: State):
         '''
-        The predictor
+        The completer
 
         Args:
             state (State): The state to be completed
         '''
         j = state.start_idx
         k = state.end_idx
-        for state_in_chart in self.chart[j]:
-            if state_in_chart.next_cat() == state.lhs:
-                i = state_in_chart.start_idx
-                state_to_add = State(state_in_chart.lhs,
-                                     state_in_chart.rhs,
-                                     i,
-                                     k,
-                                     state_in_chart.dot_idx + 1)
-                state_to_add.backpointers = list(state_in_chart.backpointers)
-                state_to_add.backpointers.append(state.uid)
+        for state_in_chart in self.chart.waiting(j, state.lhs):
+            i = state_in_chart.start_idx
+            state_to_add = State(state_in_chart.lhs,
+                                 state_in_chart.rule,
+                                 state_in_chart.rhs,
+                                 i,
+                                 k,
+                                 state_in_chart.dot_idx + 1)
+            state_to_add.backpointers = state_in_chart.backpointers + (state.uid,)
+            if self.log_space:
+                state_to_add.fwd_prob = state_in_chart.fwd_prob + state.in_prob
+                state_to_add.in_prob = state_in_chart.in_prob + state.in_prob
+            else:
                 state_to_add.fwd_prob = state_in_chart.fwd_prob * state.in_prob
                 state_to_add.in_prob = state_in_chart.in_prob * state.in_prob
-                self.chart.enqueue(state_to_add, k)
+            self.chart.enqueue(state_to_add, k)
+        if self.closure is None or state.rule == UNARY:
+            return
+        # The chains of unary rules over the state, in one step: the closure has
+        # the best chain to every symbol, and the states of chains are not
+        # extended again. Only the symbols some state waits for are built.
+        for symbol, chain_prob, label in self.closure[state.lhs]:
+            if self.chart.waiting(j, symbol):
+                state_to_add = State(symbol, UNARY, UNARY_RHS, j, k, 1)
+                state_to_add.backpointers = (state.uid,)
+                state_to_add.word = label
+                if self.log_space:
+                    state_to_add.in_prob = chain_prob + state.in_prob
+                else:
+                    state_to_add.in_prob = chain_prob * state.in_prob
+                state_to_add.fwd_prob = state_to_add.in_prob
+                self.chart.enqueue(state_to_add, k, prune=False)
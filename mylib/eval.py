@@ -1,7 +1,9 @@
 #! /usr/bin/python
 from __future__ import division
 import sys, re, json
+import multiprocessing
 from collections import defaultdict
+from itertools import islice
 from sys import stdin, stderr
 
 """
@@ -16,6 +18,13 @@ class ParseError(Exception):
     return self.value
 
 
+class ParseTimeout(ParseError):
+  "A parse stopped because it ran out of time."
+
+
+# The labels of every nonterminal seen so far, see TreeOperations._labels
+_LABELS = {}
+
 class TreeOperations:
   "Some basic operations on trees." 
   def __init__(self, tree): 
@@ -25,45 +34,55 @@ class TreeOperations:
     "Remove the vertical markovization." 
     return re.sub(r"\^<.*?>", '', nt)
 
-  def _convert_to_spans(self, tree, start, set, parent = None): 
-    "Convert a tree into spans (X, i, j) and add to a set." 
-    if len(tree) == 3:
-      # Binary rule.
-      # Remove unary collapsing.
-      current = self._remove_vertical_markovization(tree[0]).split("+")
-      split = self._convert_to_spans(tree[1], start, set, None)
-      end = self._convert_to_spans(tree[2], split + 1, set, current[-1])
-
-      # Add phrases to set
-      if current[0] != parent: 
-        set.add((current[0], start, end))
-      for nt in current[1:]:
-        set.add((nt, start, end))
-      return end
-    elif len(tree) == 2:
-      # Unary rule.
-      
-      # Can have a constituent if it is collapsed.
-      current = self._remove_vertical_markovization(tree[0]).split("+")
-      for nt in current[:-1]:
-        set.add((nt, start, start))
-      return start
+  def _labels(self, nt):
+    "The labels of a nonterminal: without vertical markovization, split on the unary collapses."
+    labels = _LABELS.get(nt)
+    if labels is None:
+      labels = _LABELS[nt] = self._remove_vertical_markovization(nt).split("+")
+    return labels
+
+  def analyze(self, check=True):
+    """Get the fringe of the tree and its set of spans (X, i, j), in one pass
+    without recursion. With check, also check that it is well formed."""
+    fringe, spans = [], set()
+    # (node, label of its parent if it is a right child, start) where start is
+    # set once the children of the node are on the stack
+    stack = [(self.tree, None, None)]
+    while stack:
+      node, parent, start = stack.pop()
+      if start is not None:
+        # Both children are done: the node ends at the last word so far
+        current = self._labels(node[0])
+        end = len(fringe)
+        if current[0] != parent:
+          spans.add((current[0], start, end))
+        for nt in current[1:]:
+          spans.add((nt, start, end))
+        continue
+      if check:
+        self._check_node(node)
+      if len(node) == 3:
+        # Binary rule, the left child first
+        stack.append((node, parent, len(fringe) + 1))
+        stack.append((node[2], self._labels(node[0])[-1], None))
+        stack.append((node[1], None, None))
+      elif len(node) == 2:
+        # Unary rule, can have a constituent if it is collapsed
+        fringe.append(node[1])
+        position = len(fringe)
+        for nt in self._labels(node[0])[:-1]:
+          spans.add((nt, position, position))
+    return fringe, spans
 
   def to_spans(self):
     "Convert the tree to a set of nonterms and spans."
-    s = set()
-    self._convert_to_spans(self.tree, 1, s)
-    return s
-
-  def _fringe(self, node):
-    if len(node) == 2: return [node[1]]
-    else: return self._fringe(node[1]) + self._fringe(node[2])
+    return self.analyze(check=False)[1]
 
   def fringe(self):
     "Return the fringe of the tree."
-    return self._fringe(self.tree)
+    return self.analyze(check=False)[0]
 
-  def _well_formed(self, node):
+  def _check_node(self, node):
     if len(node) not in [2, 3]:
       raise ParseError("Ill-formed tree:  %d-ary rule, only binary or unary allowed %s"%(len(node), node))
     
@@ -78,11 +97,15 @@ class TreeOperations:
         raise ParseError("Ill-formed tree: binary rule produces a string %s."%(node[1]))
       if isinstance(node[2], str):
         raise ParseError("Ill-formed tree: binary rule produces a string %s."%(node[2]))
-      self._well_formed(node[1])
-      self._well_formed(node[2])
       
   def check_well_formed(self):
-    self._well_formed(self.tree)
+    stack = [self.tree]
+    while stack:
+      node = stack.pop()
+      self._check_node(node)
+      if len(node) == 3:
+        stack.append(node[2])
+        stack.append(node[1])
 
 class FScore:
   "Compute F1-Score based on gold set and test set."
@@ -98,6 +121,13 @@ class FScore:
     self.test += len(test_set)
     self.correct += len(gold_set & test_set)
 
+  def __iadd__(self, other):
+    "Add the examples of another score, e.g. of other trees."
+    self.gold += other.gold
+    self.test += other.test
+    self.correct += other.correct
+    return self
+
   def fscore(self): 
     pr = self.precision() + self.recall()
     if pr == 0: return 0.0
@@ -112,16 +142,31 @@ class FScore:
     return self.correct / self.gold    
 
   @staticmethod
-  def output_header():
+  def output_header(file=None):
     "Output a scoring header."
     print("%10s  %10s  %10s  %10s   %10s"%(
-      "Type", "Total", "Precision", "Recall", "F1-Score"))
-    print("===============================================================")
+      "Type", "Total", "Precision", "Recall", "F1-Score"), file=file)
+    print("===============================================================", file=file)
 
-  def output_row(self, name):
+  def output_row(self, name, file=None):
     "Output a scoring row."
     print("%10s        %4d     %0.3f        %0.3f        %0.3f"%(
-      name, self.gold, self.precision(), self.recall(), self.fscore()))
+      name, self.gold, self.precision(), self.recall(), self.fscore()), file=file)
+
+
+def _score_chunk(pairs):
+  "Score a chunk of tree pairs in a worker process."
+  evaluator = ParseEvaluator()
+  for trees in pairs:
+    evaluator.add(*trees)
+  return evaluator
+
+def _chunks(pairs, size):
+  pairs = iter(pairs)
+  chunk = list(islice(pairs, size))
+  while chunk:
+    yield chunk
+    chunk = list(islice(pairs, size))
 
 
 class ParseEvaluator:
@@ -129,39 +174,65 @@ class ParseEvaluator:
     self.total_score = FScore()
     self.nt_score = defaultdict(FScore)
     
-  def compute_fscore(self, key_trees, predicted_trees):
-    for trees in zip(key_trees, predicted_trees):
-      tops = list(map(TreeOperations, trees))
-      tops[0].check_well_formed()
-      tops[1].check_well_formed()
-      f1, f2 = tops[0].fringe(), tops[1].fringe()
-
-      if len(f1) != len(f2): 
-        raise ParseError("Sentence length does not match. Gold sentence length %d, test sentence length %d. Sentence '%s'"%(len(f1), len(f2), " ".join(f1)))
-
-      for gold, test in zip(f1, f2):
-        if test != "_RARE_" and  gold != test:
-          raise ParseError("Tree words do not match. Gold sentence '%s', test sentence '%s'."%(" ".join(f1), " ".join(f2)))
-          exit()
-      set1, set2 = tops[0].to_spans(), tops[1].to_spans()
-
-      # Compute non-terminal specific stats.
-      for nt in set([s[0] for s in set1 | set2]):
-        filter_s1 = set([s for s in set1 if s[0] == nt])
-        filter_s2 = set([s for s in set2 if s[0] == nt])
-        self.nt_score[nt].increment(filter_s1, filter_s2)
-
-      # Compute total stats.
-      self.total_score.increment(set1, set2)
+  def compute_fscore(self, key_trees, predicted_trees, workers=1, chunk_size=256):
+    """Score all tree pairs; the trees can come from generators. With more than
+    one worker, chunks of pairs are scored by a pool of processes and their
+    scores added up, which gives the same numbers."""
+    pairs = zip(key_trees, predicted_trees)
+    if workers <= 1:
+      for trees in pairs:
+        self.add(*trees)
+      return self.total_score
+    if 'fork' in multiprocessing.get_all_start_methods():
+      context = multiprocessing.get_context('fork')
+    else:
+      context = multiprocessing.get_context()
+    with context.Pool(workers) as pool:
+      # In order, so the first ill-formed pair raises as without workers
+      for partial in pool.imap(_score_chunk, _chunks(pairs, chunk_size)):
+        self += partial
     return self.total_score
 
-  def output(self):
+  def __iadd__(self, other):
+    "Add the scores of another evaluator, e.g. of other trees."
+    self.total_score += other.total_score
+    for nt, score in other.nt_score.items():
+      self.nt_score[nt] += score
+    return self
+
+  def add(self, key_tree, predicted_tree):
+    """Score one more pair of trees. A failed parse, the tree [''] the parsers
+    write for it, predicts no constituent, so its gold ones only count in recall."""
+    f1, set1 = TreeOperations(key_tree).analyze()
+    if predicted_tree == ['']:
+      f2, set2 = f1, set()
+    else:
+      f2, set2 = TreeOperations(predicted_tree).analyze()
+
+    if len(f1) != len(f2): 
+      raise ParseError("Sentence length does not match. Gold sentence length %d, test sentence length %d. Sentence '%s'"%(len(f1), len(f2), " ".join(f1)))
+
+    for gold, test in zip(f1, f2):
+      if test != "_RARE_" and  gold != test:
+        raise ParseError("Tree words do not match. Gold sentence '%s', test sentence '%s'."%(" ".join(f1), " ".join(f2)))
+
+    # Compute non-terminal specific stats, with the spans grouped by label.
+    gold_spans, test_spans = defaultdict(set), defaultdict(set)
+    for span in set1:
+      gold_spans[span[0]].add(span)
+    for span in set2:
+      test_spans[span[0]].add(span)
+    for nt in gold_spans.keys() | test_spans.keys():
+      self.nt_score[nt].increment(gold_spans.get(nt, set()), test_spans.get(nt, set()))
+
+    # Compute total stats.
+    self.total_score.increment(set1, set2)
+
+  def output(self, file=None):
     "Print out the f-score table."
-    FScore.output_header()
+    FScore.output_header(file)
     nts = self.nt_score.keys()
     for nt in sorted(nts):
-      self.nt_score[nt].output_row(nt)
-    print()
-    self.total_score.output_row("total")
-
-
+      self.nt_score[nt].output_row(nt, file)
+    print(file=file)
+    self.total_score.output_row("total", file)
@@ -0,0 +1,125 @@
+'''
+A module that counts the rules of a treebank, one JSON tree per line, in
+parallel: the file is cut into byte ranges that worker processes count on
+their own, and their counts add up to those of the whole treebank.
+'''
+
+import hashlib
+import multiprocessing
+import os
+from collections import Counter
+from json import loads
+
+# The version of what is counted, part of the name of the grammars cached by
+# PCFG.learn_from_treebank: bump it whenever TreebankCounts counts otherwise
+# (2: unary rules between symbols)
+COUNTS_VERSION = 2
+
+
+class TreebankCounts():
+    '''
+    The counts of the symbols, rules and words of some trees. Counts merge with
+    +=, in any order, into the counts of all of their trees. unary_count counts
+    the rules producing a word, unary_rule_count those producing a symbol.
+    '''
+    def __init__(self):
+        self.sym_count = Counter()
+        self.unary_count = Counter()
+        self.unary_rule_count = Counter()
+        self.binary_count = Counter()
+        self.words_count = Counter()
+
+    def __iadd__(self, other):
+        self.sym_count.update(other.sym_count)
+        self.unary_count.update(other.unary_count)
+        self.unary_rule_count.update(other.unary_rule_count)
+        self.binary_count.update(other.binary_count)
+        self.words_count.update(other.words_count)
+        return self
+
+    def count(self, tree):
+        '''
+        Count the symbols, rules and words of a tree in Chomsky normal form,
+        possibly with unary rules between symbols.
+        '''
+        sym_count, unary_count = self.sym_count, self.unary_count
+        binary_count, words_count = self.binary_count, self.words_count
+        stack = [tree]
+        while stack:
+            tree = stack.pop()
+            sym = tree[0]
+            sym_count[sym] += 1
+            if len(tree) == 3:
+                # Binary rule, the children are counted next
+                binary_count[sym, tree[1][0], tree[2][0]] += 1
+                stack.append(tree[2])
+                stack.append(tree[1])
+            elif len(tree) == 2 and isinstance(tree[1], list):
+                # Unary rule between symbols, the child is counted next
+                self.unary_rule_count[sym, tree[1][0]] += 1
+                stack.append(tree[1])
+            elif len(tree) == 2:
+                # Unary rule
+                word = tree[1]
+                unary_count[sym, word] += 1
+                words_count[word] += 1
+
+
+def count_range(treebank, start, end):
+    '''
+    Count the trees of the lines that start in a byte range of a treebank.
+
+    Returns:
+        TreebankCounts: Their counts.
+    '''
+    counts = TreebankCounts()
+    with open(treebank, 'rb') as lines:
+        if start > 0:
+            # Skip the rest of the line before, unless start is the first byte of a line
+            lines.seek(start - 1)
+            lines.readline()
+        while lines.tell() < end:
+            line = lines.readline()
+            if not line:
+                break
+            if line.strip():
+                counts.count(loads(line))
+    return counts
+
+
+def count_treebank(treebank, workers=1, shards_per_worker=4):
+    '''
+    Count the trees of a treebank, in parallel if there is more than one worker.
+
+    The file is cut into shards_per_worker byte ranges per worker, so that the
+    workers finish together even if some ranges have longer trees.
+
+    Returns:
+        TreebankCounts: The counts of all of the trees.
+    '''
+    if workers <= 1:
+        return count_range(treebank, 0, os.path.getsize(treebank))
+    size = os.path.getsize(treebank)
+    shards = workers * shards_per_worker
+    bounds = [size * i // shards for i in range(shards + 1)]
+    ranges = [(treebank, start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+    counts = TreebankCounts()
+    with context.Pool(workers) as pool:
+        for shard in pool.starmap(count_range, ranges):
+            counts += shard
+    return counts
+
+
+def treebank_digest(treebank, block_size=1 << 20):
+    '''
+    The SHA-1 of the content of a treebank file, as hex.
+    '''
+    digest = hashlib.sha1()
+    with open(treebank, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
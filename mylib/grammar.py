@@ -0,0 +1,676 @@
+'''
+A module that compiles a PCFG into integer-indexed rule tables, and stores
+them in a versioned binary file that is loaded through mmap.
+'''
+
+import hashlib
+import heapq
+import mmap
+import struct
+
+import numpy as np
+
+MAGIC = b'PCFGBIN\0'
+VERSION = 2
+HEADER = struct.Struct('<8sII')
+SECTION = struct.Struct('<QQ')
+
+# The arrays of a compiled grammar file, in the order they are stored
+ARRAYS = [
+    ('parent_offsets', np.int32),
+    ('rule_parent', np.int32),
+    ('rule_left', np.int32),
+    ('rule_right', np.int32),
+    ('rule_prob', np.float64),
+    ('rule_log_prob', np.float64),
+    ('left_order', np.int32),
+    ('left_offsets', np.int32),
+    ('right_order', np.int32),
+    ('right_offsets', np.int32),
+    ('word_offsets', np.int32),
+    ('lex_symbol', np.int32),
+    ('lex_prob', np.float64),
+    ('lex_log_prob', np.float64),
+    ('unary_parent', np.int32),
+    ('unary_child', np.int32),
+    ('unary_prob', np.float64),
+    ('closure_offsets', np.int32),
+    ('closure_parent', np.int32),
+    ('closure_next', np.int32),
+    ('closure_prob', np.float64),
+    ('closure_log_prob', np.float64),
+]
+# The string tables, each stored as utf-8 bytes plus byte offsets
+STRINGS = ['symbols', 'words', 'known_words']
+
+
+def _index(keys, size):
+    '''
+    Build a CSR-style index over an array of keys.
+
+    Args:
+        keys (ndarray): The key of every entry.
+        size (int): The number of distinct keys.
+
+    Returns:
+        tuple: The entries ordered by key (stable) and the offsets of each key.
+    '''
+    order = np.argsort(keys, kind='stable').astype(np.int32)
+    offsets = np.zeros(size + 1, dtype=np.int32)
+    np.cumsum(np.bincount(keys, minlength=size), out=offsets[1:])
+    return order, offsets
+
+
+def _unary_closure(parents, children, probs, size):
+    '''
+    Find the best chain of unary rules X -> ... -> Y of every pair of symbols.
+
+    Probabilities are at most 1, so the best chains up from each child Y are
+    found as shortest paths (Dijkstra), and a chain never goes round a cycle.
+
+    Returns:
+        tuple: The closure grouped by child: the offsets of each child, and the
+            parent X, the next symbol after X on the chain and the probability
+            of every pair with a chain of one rule or more.
+    '''
+    rules = [[] for _ in range(size)]
+    for x, y, p in zip(parents.tolist(), children.tolist(), probs.tolist()):
+        rules[y].append((x, p))
+    offsets = np.zeros(size + 1, dtype=np.int32)
+    closure = []
+    for y in range(size):
+        if rules[y]:
+            best, following, agenda = {y: 1.0}, {}, [(-1.0, y)]
+            while agenda:
+                score, z = heapq.heappop(agenda)
+                if -score < best[z]:
+                    continue
+                for x, p in rules[z]:
+                    if -score * p > best.get(x, 0.0):
+                        best[x], following[x] = -score * p, z
+                        heapq.heappush(agenda, (score * p, x))
+            closure.extend((x, following[x], best[x]) for x in sorted(following))
+        offsets[y + 1] = len(closure)
+    closure = np.array(closure, dtype=np.float64).reshape(-1, 3)
+    return (offsets, closure[:, 0].astype(np.int32), closure[:, 1].astype(np.int32),
+            np.ascontiguousarray(closure[:, 2]))
+
+
+class CompiledGrammar():
+    '''
+    A CompiledGrammar keeps the rules of a PCFG with every symbol interned to an
+    integer id. Binary rules are stored in arrays grouped by parent and indexed
+    by left and by right child, and lexical rules are indexed by word. Unary
+    rules between symbols are stored with their closure: the best chain of them
+    from every symbol to every other, so parsers apply them in one step.
+    '''
+    def __init__(self, q1, q2, q3=None):
+        '''
+        Compile the rule tables.
+
+        Nonterminals are numbered in sorted order, so comparing ids gives the
+        same result as comparing the symbols themselves.
+
+        Args:
+            q1 (dict): The lexical rule probabilities, keyed by (X, word).
+            q2 (dict): The binary rule probabilities, keyed by (X, Y1, Y2).
+            q3 (dict): The unary rule probabilities, keyed by (X, Y), or None.
+        '''
+        q3 = q3 if q3 is not None else {}
+        symbols = set()
+        for x, _ in q1.keys():
+            symbols.add(x)
+        for x, y1, y2 in q2.keys():
+            symbols.update((x, y1, y2))
+        for x, y in q3.keys():
+            symbols.update((x, y))
+        self.symbols = sorted(symbols)
+        self.symbol_ids = {sym: idx for idx, sym in enumerate(self.symbols)}
+        ids = self.symbol_ids
+
+        # Binary rules, grouped by parent in the order they were read
+        rules = np.array([(ids[x], ids[y1], ids[y2]) for x, y1, y2 in q2.keys()],
+                         dtype=np.int32).reshape(-1, 3)
+        probs = np.fromiter(q2.values(), dtype=np.float64, count=len(q2))
+        order, self.parent_offsets = _index(rules[:, 0], len(self.symbols))
+        self.rule_parent = np.ascontiguousarray(rules[order, 0])
+        self.rule_left = np.ascontiguousarray(rules[order, 1])
+        self.rule_right = np.ascontiguousarray(rules[order, 2])
+        self.rule_prob = probs[order]
+        self.rule_log_prob = np.log(self.rule_prob)
+        self.left_order, self.left_offsets = _index(self.rule_left, len(self.symbols))
+        self.right_order, self.right_offsets = _index(self.rule_right, len(self.symbols))
+
+        # Lexical rules, grouped by word
+        self.words = sorted(set(word for _, word in q1.keys()))
+        self.word_ids = {word: idx for idx, word in enumerate(self.words)}
+        lex = np.array([(self.word_ids[word], ids[x]) for x, word in q1.keys()],
+                       dtype=np.int32).reshape(-1, 2)
+        probs = np.fromiter(q1.values(), dtype=np.float64, count=len(q1))
+        order, self.word_offsets = _index(lex[:, 0], len(self.words))
+        self.lex_symbol = np.ascontiguousarray(lex[order, 1])
+        self.lex_prob = probs[order]
+        self.lex_log_prob = np.log(self.lex_prob)
+
+        # Unary rules, sorted, and their closure
+        unary = sorted((ids[x], ids[y], p) for (x, y), p in q3.items())
+        self.unary_parent = np.array([x for x, _, _ in unary], dtype=np.int32)
+        self.unary_child = np.array([y for _, y, _ in unary], dtype=np.int32)
+        self.unary_prob = np.array([p for _, _, p in unary], dtype=np.float64)
+        (self.closure_offsets, self.closure_parent, self.closure_next,
+         self.closure_prob) = _unary_closure(self.unary_parent, self.unary_child, self.unary_prob,
+                                             len(self.symbols))
+        self.closure_log_prob = np.log(self.closure_prob)
+
+        self.__views = {}
+
+    @classmethod
+    def from_arrays(cls, arrays, symbols, words):
+        '''
+        Create a compiled grammar from already compiled tables, without copying them.
+
+        Args:
+            arrays (dict): The arrays named in ARRAYS.
+            symbols (list): The symbol of every id.
+            words (list): The word of every id.
+        '''
+        grammar = cls.__new__(cls)
+        for name, _ in ARRAYS:
+            setattr(grammar, name, arrays[name])
+        grammar.symbols = symbols
+        grammar.symbol_ids = {sym: idx for idx, sym in enumerate(symbols)}
+        grammar.words = words
+        grammar.word_ids = {word: idx for idx, word in enumerate(words)}
+        grammar.__views = {}
+        return grammar
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def word_id(self, word):
+        '''
+        Get the id of a (normalized) word.
+
+        Returns:
+            int: The word id, or -1 if no preterminal produces the word.
+        '''
+        return self.word_ids.get(word, -1)
+
+    def parent_rules(self, parent):
+        '''
+        Get the ids of the binary rules with the given parent.
+        '''
+        return range(self.parent_offsets[parent], self.parent_offsets[parent + 1])
+
+    def preterminals(self, word, log=False):
+        '''
+        Get the preterminals producing a word and their probabilities.
+
+        Args:
+            word (int): The word id.
+            log (bool): Whether to return log-probabilities.
+
+        Returns:
+            tuple: The preterminal ids and their probabilities, as arrays.
+        '''
+        probs = self.lex_log_prob if log else self.lex_prob
+        if word < 0:
+            return self.lex_symbol[:0], probs[:0]
+        lo, hi = self.word_offsets[word], self.word_offsets[word + 1]
+        return self.lex_symbol[lo:hi], probs[lo:hi]
+
+    def project(self, coarse):
+        '''
+        Build the grammar of coarser symbols, e.g. with every NP|... symbol of the
+        binarization mapped to NP.
+
+        A coarse rule gets the highest probability of the rules mapped onto it, so
+        the score of a coarse tree bounds the scores of the trees mapped onto it.
+
+        Args:
+            coarse (callable): Maps a symbol to its coarse symbol.
+
+        Returns:
+            tuple: The coarse CompiledGrammar and the coarse id of every symbol, as an array.
+        '''
+        names = [coarse(sym) for sym in self.symbols]
+        q1, q2, q3 = {}, {}, {}
+        for word in range(len(self.words)):
+            lo, hi = self.word_offsets[word], self.word_offsets[word + 1]
+            for x, p in zip(self.lex_symbol[lo:hi].tolist(), self.lex_prob[lo:hi].tolist()):
+                key = (names[x], self.words[word])
+                q1[key] = max(q1.get(key, 0.0), p)
+        for x, y1, y2, p in zip(self.rule_parent.tolist(), self.rule_left.tolist(),
+                                self.rule_right.tolist(), self.rule_prob.tolist()):
+            key = (names[x], names[y1], names[y2])
+            q2[key] = max(q2.get(key, 0.0), p)
+        for x, y, p in zip(self.unary_parent.tolist(), self.unary_child.tolist(),
+                           self.unary_prob.tolist()):
+            if names[x] != names[y]:
+                q3[names[x], names[y]] = max(q3.get((names[x], names[y]), 0.0), p)
+        grammar = CompiledGrammar(q1, q2, q3)
+        return grammar, np.array([grammar.symbol_ids[name] for name in names], dtype=np.int32)
+
+    def __view(self, name, build, *args):
+        if name not in self.__views:
+            self.__views[name] = build(*args)
+        return self.__views[name]
+
+    def __by_parent(self, probs):
+        rules = list(zip(range(len(probs)), probs.tolist()))
+        offsets = self.parent_offsets.tolist()
+        return [sorted(rules[offsets[x]:offsets[x + 1]], key=lambda r: -r[1])
+                for x in range(len(self))]
+
+    def __by_left(self, probs):
+        order = self.left_order
+        rules = list(zip(self.rule_parent[order].tolist(),
+                         self.rule_right[order].tolist(),
+                         probs[order].tolist()))
+        offsets = self.left_offsets.tolist()
+        return [rules[offsets[x]:offsets[x + 1]] for x in range(len(self))]
+
+    def __by_right(self, probs):
+        order = self.right_order
+        rules = list(zip(self.rule_parent[order].tolist(),
+                         self.rule_left[order].tolist(),
+                         probs[order].tolist()))
+        offsets = self.right_offsets.tolist()
+        return [rules[offsets[x]:offsets[x + 1]] for x in range(len(self))]
+
+    def __by_children(self, probs):
+        rules = {}
+        for parent, left, right, prob in zip(self.rule_parent.tolist(), self.rule_left.tolist(),
+                                             self.rule_right.tolist(), probs.tolist()):
+            rules.setdefault((left, right), []).append((parent, prob))
+        return rules
+
+    def __best_parent(self, probs, zero):
+        best = np.full(len(self), zero)
+        np.maximum.at(best, self.rule_left, probs)
+        np.maximum.at(best, self.rule_right, probs)
+        return best.tolist()
+
+    def __outside_estimates(self, length):
+        # Inside estimates first: the best inside probability of each symbol over
+        # k words, every word taking the best probability it has for a preterminal
+        size = len(self)
+        inside = np.zeros((length + 1, size))
+        np.maximum.at(inside[1], self.lex_symbol, self.lex_prob)
+        parents = np.flatnonzero(self.parent_offsets[1:] > self.parent_offsets[:-1])
+        starts = self.parent_offsets[:-1][parents]
+        for k in range(2, length + 1):
+            for a in range(1, k):
+                scores = self.rule_prob * inside[a][self.rule_left] * inside[k - a][self.rule_right]
+                inside[k][parents] = np.maximum(inside[k][parents], np.maximum.reduceat(scores, starts))
+        # Then the outside estimates, from the parent and the sibling of each symbol
+        outside = np.zeros((length, size))
+        outside[0] = 1.0
+        lefts = np.flatnonzero(self.left_offsets[1:] > self.left_offsets[:-1])
+        rights = np.flatnonzero(self.right_offsets[1:] > self.right_offsets[:-1])
+        for o in range(1, length):
+            for k in range(1, o + 1):
+                scores = (self.rule_prob * inside[k][self.rule_right] * outside[o - k][self.rule_parent])
+                outside[o][lefts] = np.maximum(outside[o][lefts], np.maximum.reduceat(
+                    scores[self.left_order], self.left_offsets[:-1][lefts]))
+                scores = (self.rule_prob * inside[k][self.rule_left] * outside[o - k][self.rule_parent])
+                outside[o][rights] = np.maximum(outside[o][rights], np.maximum.reduceat(
+                    scores[self.right_order], self.right_offsets[:-1][rights]))
+        return outside
+
+    def outside_estimates(self, length):
+        '''
+        Get upper bounds of the outside probability of every symbol, for spans
+        with o words outside them, in sentences of up to length words.
+
+        The bound is the best outside probability the symbol can have when every
+        word takes the best lexical probability of its preterminal, whatever the
+        word. It is consistent: the bound of a symbol is at least the rule
+        probability times the sibling's bound times the parent's bound.
+
+        Returns:
+            ndarray: The bounds, indexed by [o, symbol].
+        '''
+        estimates = self.__views.get('outside_estimates')
+        if estimates is None or len(estimates) < length:
+            # Grow geometrically, the estimates take a quadratic time in the length
+            size = max(length, 2 * len(estimates) if estimates is not None else 40)
+            estimates = self.__views['outside_estimates'] = self.__outside_estimates(size)
+        return estimates
+
+    def __closure(self, probs):
+        # The chains of every child, each with the label of its collapsed node
+        parents, following = self.closure_parent.tolist(), self.closure_next.tolist()
+        offsets, probs = self.closure_offsets.tolist(), probs.tolist()
+        closure = []
+        for y in range(len(self)):
+            lo, hi = offsets[y], offsets[y + 1]
+            steps = dict(zip(parents[lo:hi], following[lo:hi]))
+            chains = []
+            for x, p in zip(parents[lo:hi], probs[lo:hi]):
+                path = [x]
+                while path[-1] != y:
+                    path.append(steps.get(path[-1], y))
+                chains.append((x, p, '+'.join(self.symbols[z] for z in path)))
+            closure.append(chains)
+        return closure
+
+    def __closure_by_parent(self, probs):
+        closure = [[] for _ in range(len(self))]
+        offsets = self.closure_offsets.tolist()
+        for y in range(len(self)):
+            for x, p in zip(self.closure_parent[offsets[y]:offsets[y + 1]].tolist(),
+                            probs[offsets[y]:offsets[y + 1]].tolist()):
+                closure[x].append((y, p))
+        return [sorted(chains, key=lambda c: -c[1]) for chains in closure]
+
+    def __lexical(self, probs):
+        rules = list(zip(self.lex_symbol.tolist(), probs.tolist()))
+        offsets = self.word_offsets.tolist()
+        return [dict(rules[offsets[w]:offsets[w + 1]]) for w in range(len(self.words))]
+
+    @property
+    def binary_by_parent(self):
+        '''
+        The (rule, prob) binary rules of each parent, as Python lists sorted by
+        decreasing probability (in reading order for equal probabilities).
+        '''
+        return self.__view('binary_by_parent', self.__by_parent, self.rule_prob)
+
+    @property
+    def log_binary_by_parent(self):
+        '''
+        The binary_by_parent rules with log-probabilities.
+        '''
+        return self.__view('log_binary_by_parent', self.__by_parent, self.rule_log_prob)
+
+    @property
+    def rule_rhs(self):
+        '''
+        The (left, right) children of every binary rule, as Python tuples.
+        '''
+        def build():
+            return list(zip(self.rule_left.tolist(), self.rule_right.tolist()))
+        return self.__view('rule_rhs', build)
+
+    @property
+    def binary_by_left(self):
+        '''
+        The (parent, right, prob) binary rules of each left child, as Python lists.
+        '''
+        return self.__view('binary_by_left', self.__by_left, self.rule_prob)
+
+    @property
+    def log_binary_by_left(self):
+        '''
+        The binary_by_left rules with log-probabilities.
+        '''
+        return self.__view('log_binary_by_left', self.__by_left, self.rule_log_prob)
+
+    @property
+    def binary_by_right(self):
+        '''
+        The (parent, left, prob) binary rules of each right child, as Python lists.
+        '''
+        return self.__view('binary_by_right', self.__by_right, self.rule_prob)
+
+    @property
+    def log_binary_by_right(self):
+        '''
+        The binary_by_right rules with log-probabilities.
+        '''
+        return self.__view('log_binary_by_right', self.__by_right, self.rule_log_prob)
+
+    @property
+    def binary_by_children(self):
+        '''
+        The (parent, prob) binary rules of each (left, right) pair of children, as
+        a Python dict of lists.
+        '''
+        return self.__view('binary_by_children', self.__by_children, self.rule_prob)
+
+    @property
+    def log_binary_by_children(self):
+        '''
+        The binary_by_children rules with log-probabilities.
+        '''
+        return self.__view('log_binary_by_children', self.__by_children, self.rule_log_prob)
+
+    @property
+    def best_parent_rule(self):
+        '''
+        The highest probability of a rule having each symbol as a child, or 0 for
+        the symbols that are never a child, as a Python list.
+        '''
+        return self.__view('best_parent_rule', self.__best_parent, self.rule_prob, 0.0)
+
+    @property
+    def log_best_parent_rule(self):
+        '''
+        The best_parent_rule log-probabilities.
+        '''
+        return self.__view('log_best_parent_rule', self.__best_parent, self.rule_log_prob, -np.inf)
+
+    @property
+    def has_unary_rules(self):
+        '''
+        Whether the grammar has unary rules between symbols.
+        '''
+        return len(self.unary_parent) > 0
+
+    @property
+    def unary_closure(self):
+        '''
+        The (parent, prob, label) chains of unary rules up from each child, as
+        Python lists: the best chain from parent down to the child, and the
+        label of the node it collapses into, e.g. "S+VP" for S -> VP.
+        '''
+        return self.__view('unary_closure', self.__closure, self.closure_prob)
+
+    @property
+    def log_unary_closure(self):
+        '''
+        The unary_closure chains with log-probabilities.
+        '''
+        return self.__view('log_unary_closure', self.__closure, self.closure_log_prob)
+
+    @property
+    def unary_closure_by_parent(self):
+        '''
+        The (child, prob) chains of unary rules down from each parent, as Python
+        lists sorted by decreasing probability.
+        '''
+        return self.__view('unary_closure_by_parent', self.__closure_by_parent, self.closure_prob)
+
+    @property
+    def log_unary_closure_by_parent(self):
+        '''
+        The unary_closure_by_parent chains with log-probabilities.
+        '''
+        return self.__view('log_unary_closure_by_parent', self.__closure_by_parent,
+                           self.closure_log_prob)
+
+    @property
+    def lexical(self):
+        '''
+        The (preterminal, prob) rules of each word id, as Python dicts.
+        '''
+        return self.__view('lexical', self.__lexical, self.lex_prob)
+
+    @property
+    def log_lexical(self):
+        '''
+        The lexical rules with log-probabilities.
+        '''
+        return self.__view('log_lexical', self.__lexical, self.lex_log_prob)
+
+    @property
+    def fingerprint(self):
+        '''
+        A hex digest of the rules, which changes whenever the grammar does.
+        '''
+        def build():
+            digest = hashlib.sha1()
+            for name, dtype in ARRAYS:
+                digest.update(np.ascontiguousarray(getattr(self, name), dtype=dtype).tobytes())
+            for strings in (self.symbols, self.words):
+                digest.update('\0'.join(strings).encode('utf-8') + b'\1')
+            return digest.hexdigest()
+        return self.__view('fingerprint', build)
+
+    @property
+    def is_preterminal(self):
+        '''
+        Whether each symbol produces words, as a Python list.
+        '''
+        def build():
+            flags = np.zeros(len(self), dtype=bool)
+            flags[self.lex_symbol] = True
+            return flags.tolist()
+        return self.__view('is_preterminal', build)
+
+
+class Lexicon():
+    '''
+    A Lexicon maps the known words of a grammar to their word ids in the compiled
+    grammar. Every other word is normalized to _RARE_.
+    '''
+    RARE = '_RARE_'
+
+    def __init__(self, known_words, grammar):
+        '''
+        Intern the known words.
+
+        Args:
+            known_words (iterable): The words not normalized to _RARE_.
+            grammar (CompiledGrammar): The grammar whose word ids to use.
+        '''
+        self.rare_id = grammar.word_id(Lexicon.RARE)
+        self.ids = {word: grammar.word_id(word) for word in known_words}
+
+    def __contains__(self, word):
+        return word in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def normalize(self, words):
+        '''
+        Normalize the words of a sentence for the charts.
+
+        Returns:
+            list: The (norm, word) pair of every word, where norm is the word if
+                it is known and _RARE_ otherwise.
+        '''
+        ids, rare = self.ids, Lexicon.RARE
+        return [(word if word in ids else rare, word) for word in words]
+
+    def word_id(self, word):
+        '''
+        Get the id of the normalized form of a word.
+
+        Returns:
+            int: The word id, or -1 if the grammar has no rule for it.
+        '''
+        return self.ids.get(word, self.rare_id)
+
+    def normalize_many(self, tokens):
+        '''
+        Normalize a sentence at once.
+
+        Args:
+            tokens (list): The tokens of the sentence.
+
+        Returns:
+            ndarray: The word id of the normalized form of every token, -1 where
+                the grammar has no rule for it.
+        '''
+        get, rare = self.ids.get, self.rare_id
+        return np.array([get(token, rare) for token in tokens], dtype=np.int32)
+
+
+def save_compiled(path, grammar, known_words):
+    '''
+    Write a compiled grammar and its known words to a binary file.
+
+    The file starts with a header (magic, version, number of sections) and a
+    table of (offset, count) pairs, followed by every section aligned to 8 bytes.
+
+    Args:
+        path (str): The file to write.
+        grammar (CompiledGrammar): The grammar to save.
+        known_words (iterable): The words not normalized to _RARE_.
+    '''
+    sections = [np.ascontiguousarray(getattr(grammar, name), dtype=dtype)
+                for name, dtype in ARRAYS]
+    for strings in (grammar.symbols, grammar.words, sorted(known_words)):
+        encoded = [s.encode('utf-8') for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(s) for s in encoded], out=offsets[1:])
+        sections.append(offsets)
+        sections.append(np.frombuffer(b''.join(encoded), dtype=np.uint8))
+
+    table = []
+    offset = HEADER.size + SECTION.size * len(sections)
+    for array in sections:
+        offset += -offset % 8
+        table.append((offset, len(array)))
+        offset += array.nbytes
+
+    with open(path, 'wb') as model:
+        model.write(HEADER.pack(MAGIC, VERSION, len(sections)))
+        for entry in table:
+            model.write(SECTION.pack(*entry))
+        for (offset, _), array in zip(table, sections):
+            model.write(b'\0' * (offset - model.tell()))
+            model.write(array.tobytes())
+
+
+def is_compiled(path):
+    '''
+    Check whether a file was written by save_compiled.
+    '''
+    with open(path, 'rb') as model:
+        return model.read(len(MAGIC)) == MAGIC
+
+
+def load_compiled(path):
+    '''
+    Load a grammar written by save_compiled.
+
+    The rule arrays are read-only views on the memory-mapped file, so only the
+    symbol and word tables are turned into Python objects.
+
+    Args:
+        path (str): The file to read.
+
+    Returns:
+        tuple: The CompiledGrammar and the list of known words.
+    '''
+    with open(path, 'rb') as model:
+        buffer = mmap.mmap(model.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, count = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        raise ValueError('{} is not a compiled grammar'.format(path))
+    if version != VERSION:
+        raise ValueError('{} has version {}, expected {}'.format(path, version, VERSION))
+    if count != len(ARRAYS) + 2 * len(STRINGS):
+        raise ValueError('{} has {} sections, expected {}'.format(
+            path, count, len(ARRAYS) + 2 * len(STRINGS)))
+
+    dtypes = [dtype for _, dtype in ARRAYS] + [np.int64, np.uint8] * len(STRINGS)
+    sections = []
+    for idx, dtype in enumerate(dtypes):
+        offset, length = SECTION.unpack_from(buffer, HEADER.size + SECTION.size * idx)
+        sections.append(np.frombuffer(buffer, dtype=dtype, count=length, offset=offset))
+
+    arrays = {name: array for (name, _), array in zip(ARRAYS, sections)}
+    strings = {}
+    for idx, name in enumerate(STRINGS):
+        offsets = sections[len(ARRAYS) + 2 * idx].tolist()
+        data = sections[len(ARRAYS) + 2 * idx + 1].tobytes()
+        strings[name] = [data[a:b].decode('utf-8') for a, b in zip(offsets, offsets[1:])]
+
+    grammar = CompiledGrammar.from_arrays(arrays, strings['symbols'], strings['words'])
+    return grammar, strings['known_words']
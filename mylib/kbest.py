@@ -0,0 +1,240 @@
+'''
+A module that extracts the k most probable trees of a sentence from its CKY
+chart, lazily as in Huang & Chiang (2005), "Better k-best parsing", algorithm 3.
+
+CKY keeps only the score of the best tree of every (Min, Max, C). The k-best
+derivations of an item are enumerated on demand, best first: the candidates of
+an item start with the best derivation of each of its binary edges, and each
+derivation taken from them adds its successors, the same edge with the next
+derivation of one of its children. Only the items the k trees reach are
+visited, and the edges of an item are found through the rules of its symbol,
+so the work added to the 1-best parse grows with k and with the size of the
+trees, not with the size of the chart.
+
+With unary rules, the derivations of an item are those of its binary edges or
+word, and those of the other symbols of the span under the best chain of unary
+rules from it, as CKY builds them.
+'''
+
+import heapq
+from itertools import islice
+
+
+class KBestChart():
+    '''
+    The k-best derivations of the items of a CKY chart, computed on demand.
+
+    A derivation of (Min, Max, C) is a tuple (-score, -C1, -C2, -Mid, j1, j2, q)
+    for the rule C -> C1 C2 of probability q over the split Mid, with the j1-th
+    derivation of (Min, Mid, C1) and the j2-th of (Mid+1, Max, C2), and (-score,)
+    for a word. Derivations compare as CKY breaks ties, so the first derivation
+    of every item is the one CKY backtraces.
+
+    With unary rules, those are the derivations of the item without a chain on
+    top, and the derivations of the item itself are (-score, chain, -Y, j, p,
+    label) for the j-th of them of (Min, Max, Y), under the chain of probability
+    p collapsed into label, or under no chain (chain 0, Y = C).
+    '''
+    def __init__(self, grammar, pi, norm_words, log_space=False):
+        '''
+        Initialize the derivations of a chart.
+
+        Args:
+            grammar (CompiledGrammar): The grammar the chart was built with.
+            pi (dict): The chart of CKY_chart, mapping (Min, Max) to the scores of its symbols.
+            norm_words (list): The (norm, word) pairs of the sentence.
+            log_space (bool): Whether the scores of the chart are log-probabilities.
+        '''
+        self.grammar = grammar
+        self.pi = pi
+        self.norm_words = norm_words
+        self.log_space = log_space
+        if log_space:
+            self.rules_by_parent, self.zero = grammar.log_binary_by_parent, float('-inf')
+            self.lexical, self.closure = grammar.log_lexical, grammar.log_unary_closure
+        else:
+            self.rules_by_parent, self.zero = grammar.binary_by_parent, 0.0
+            self.lexical, self.closure = grammar.lexical, grammar.unary_closure
+        if not grammar.has_unary_rules:
+            self.closure = None
+        # The derivations found of every item, best first, and the candidates of
+        # the next ones; expanded counts the derivations whose successors are
+        # among the candidates, seen the derivations ever made candidates
+        self.derivations = {}
+        self.candidates = {}
+        self.expanded = {}
+        self.seen = {}
+        self.edges = 0
+        # The same for the derivations with unary chains
+        self.closed = {}
+        self.closed_candidates = {}
+        self.closed_expanded = {}
+
+    def __init_item(self, Min, Max, C):
+        # The derivations of an item: its word, or the best derivation of each
+        # of its binary edges, as candidates
+        self.derivations[Min, Max, C] = []
+        self.candidates[Min, Max, C] = heap = []
+        if Min == Max:
+            w = self.grammar.word_id(self.norm_words[Min-1][0])
+            if w >= 0 and C in self.lexical[w]:
+                self.derivations[Min, Max, C].append((-self.lexical[w][C],))
+            return
+        pi, zero, log_space, rule_rhs = self.pi, self.zero, self.log_space, self.grammar.rule_rhs
+        rules = self.rules_by_parent[C]
+        for Mid in range(Min, Max):
+            left, right = pi.get((Min, Mid)), pi.get((Mid+1, Max))
+            if not left or not right:
+                continue
+            for rule, q in rules:
+                C1, C2 = rule_rhs[rule]
+                if C1 in left and C2 in right:
+                    if log_space:
+                        score = q + left[C1] + right[C2]
+                    else:
+                        score = q * left[C1] * right[C2]
+                    if score > zero:
+                        heap.append((-score, -C1, -C2, -Mid, 0, 0, q))
+        self.edges += len(heap)
+        heapq.heapify(heap)
+        self.seen[Min, Max, C] = {d[1:6] for d in heap}
+
+    def kth(self, item, j):
+        '''
+        Find the j-th best derivation of an item (Min, Max, C), from 0.
+
+        Returns:
+            tuple: The derivation, or None if the item has j derivations or fewer.
+        '''
+        if self.closure is None:
+            return self.base(item, j)
+        if item not in self.closed:
+            self.__init_closed(item[0], item[1])
+        derivations = self.closed[item]
+        candidates = self.closed_candidates[item]
+        while len(derivations) <= j:
+            # The successor of the last derivation: the next one under the same chain
+            if len(derivations) > self.closed_expanded.get(item, 0):
+                self.closed_expanded[item] = len(derivations)
+                _, chain, Y, r, p, label = derivations[-1]
+                following = self.base((item[0], item[1], -Y), r + 1)
+                if following is not None:
+                    score = -following[0]
+                    if chain:
+                        score = p + score if self.log_space else p * score
+                    heapq.heappush(candidates, (-score, chain, Y, r + 1, p, label))
+            if not candidates:
+                return None
+            derivations.append(heapq.heappop(candidates))
+        return derivations[j]
+
+    def __init_closed(self, Min, Max):
+        # The best derivation of every symbol of a span, and of every chain of
+        # unary rules over it, as candidates of the symbols of the span
+        cell = self.pi.get((Min, Max), {})
+        candidates = {C: [] for C in cell}
+        for Y in cell:
+            below = self.base((Min, Max, Y), 0)
+            if below is None:
+                continue
+            candidates[Y].append((below[0], 0, -Y, 0, None, None))
+            for X, p, label in self.closure[Y]:
+                if X in cell:
+                    score = p + -below[0] if self.log_space else p * -below[0]
+                    if score > self.zero:
+                        candidates[X].append((-score, 1, -Y, 0, p, label))
+        for C, heap in candidates.items():
+            heapq.heapify(heap)
+            self.closed[Min, Max, C] = []
+            self.closed_candidates[Min, Max, C] = heap
+
+    def base(self, item, j):
+        '''
+        Find the j-th best derivation of an item without a unary chain on top.
+
+        Returns:
+            tuple: The derivation, or None if the item has j derivations or fewer.
+        '''
+        if item not in self.derivations:
+            self.__init_item(*item)
+        derivations = self.derivations[item]
+        candidates = self.candidates[item]
+        while len(derivations) <= j:
+            # The successors of the last derivation are only needed now
+            if len(derivations) > self.expanded.get(item, 0):
+                self.expanded[item] = len(derivations)
+                self.__push_successors(item, derivations[-1])
+            if not candidates:
+                return None
+            derivations.append(heapq.heappop(candidates))
+        return derivations[j]
+
+    def __push_successors(self, item, derivation):
+        # The derivations of the same edge with the next derivation of one child
+        if len(derivation) == 1:
+            return
+        Min, Max, _ = item
+        edge, (j1, j2, q) = derivation[1:4], derivation[4:]
+        C1, C2, Mid = -edge[0], -edge[1], -edge[2]
+        seen = self.seen[item]
+        for k1, k2 in ((j1 + 1, j2), (j1, j2 + 1)):
+            if edge + (k1, k2) in seen:
+                continue
+            left = self.kth((Min, Mid, C1), k1)
+            right = self.kth((Mid+1, Max, C2), k2)
+            if left is None or right is None:
+                continue
+            if self.log_space:
+                score = q + -left[0] + -right[0]
+            else:
+                score = q * -left[0] * -right[0]
+            if score > self.zero:
+                seen.add(edge + (k1, k2))
+                heapq.heappush(self.candidates[item], (-score,) + edge + (k1, k2, q))
+
+    def tree(self, item, j):
+        '''
+        Build the tree of the j-th best derivation of an item.
+        '''
+        if self.closure is None:
+            return self.__base_tree(item, j)
+        _, chain, Y, r, _, label = self.kth(item, j)
+        tree = self.__base_tree((item[0], item[1], -Y), r)
+        if chain:
+            tree[0] = label
+        return tree
+
+    def __base_tree(self, item, j):
+        derivation = self.base(item, j)
+        Min, Max, C = item
+        if len(derivation) == 1:
+            return [self.grammar.symbols[C], self.norm_words[Min-1][1]]
+        _, C1, C2, Mid, j1, j2, _ = derivation
+        return [self.grammar.symbols[C], self.tree((Min, -Mid, -C1), j1),
+                self.tree((-Mid+1, Max, -C2), j2)]
+
+    def trees(self):
+        '''
+        Generate the trees over the whole sentence, of any symbol as CKY, best
+        first, as (tree, score) pairs.
+        '''
+        n = len(self.norm_words)
+        # The next derivation of every symbol over the sentence, merged as the
+        # candidates of an item whose edges are the symbols
+        top = [(self.kth((1, n, C), 0)[0], -C, 0) for C in self.pi.get((1, n), {})]
+        heapq.heapify(top)
+        while top:
+            score, C, j = heapq.heappop(top)
+            yield self.tree((1, n, -C), j), -score
+            following = self.kth((1, n, -C), j + 1)
+            if following is not None:
+                heapq.heappush(top, (following[0], C, j + 1))
+
+    def best(self, k):
+        '''
+        Find the k best trees over the whole sentence.
+
+        Returns:
+            list: Up to k (tree, score) pairs, best first.
+        '''
+        return list(islice(self.trees(), k))
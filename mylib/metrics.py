@@ -0,0 +1,114 @@
+'''
+A module that measures where a parser spends its time, sentence by sentence.
+
+A Parser with a ParseProfiler times the tokenizer, the normalization, the
+parse and the backtrace of every sentence, and keeps the counters of the
+algorithm (the stats of the parser). Without one, none of this is done.
+'''
+
+import cProfile
+from collections import defaultdict
+from contextlib import contextmanager
+from json import dumps
+from time import perf_counter
+
+# The phases of a sentence, in the order they run
+PHASES = ("tokenize", "normalize", "parse", "backtrace")
+
+
+class ParseProfiler():
+    '''
+    The time of every phase and the algorithm counters of the sentences parsed,
+    in total and optionally as one JSON line per sentence, and optionally a
+    cProfile of the phases.
+    '''
+    def __init__(self, metrics=None, pstats=None):
+        '''
+        Initialize a profiler.
+
+        Args:
+            metrics (str): The file to write a JSON line per sentence to, or None.
+            pstats (str): The file to dump the cProfile of the phases to when
+                closed, for pstats or snakeviz, or None not to run cProfile.
+        '''
+        self.metrics = open(metrics, "w") if metrics else None
+        self.pstats = pstats
+        self.cprofile = cProfile.Profile() if pstats else None
+        self.sentences = 0
+        self.failures = 0
+        self.totals = defaultdict(float)
+        self.row = {}
+        self.active = False
+
+    def __str__(self):
+        if not self.sentences:
+            return 'sentences: 0'
+        return 'sentences: {}, failed: {}, '.format(self.sentences, self.failures) + ', '.join(
+            '{}: {}'.format(name, '%.3fs' % value if name in PHASES else int(value))
+            for name, value in self.totals.items())
+
+    def timed(self, phase, function, *args):
+        '''
+        Call function with args and add the time it took to phase.
+        '''
+        if self.cprofile is not None:
+            self.cprofile.enable()
+        start = perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.row[phase] = self.row.get(phase, 0.0) + perf_counter() - start
+            if self.cprofile is not None:
+                self.cprofile.disable()
+
+    @contextmanager
+    def sentence(self, parser, algo, norm_words):
+        '''
+        Time the parse of a sentence with algo and record it, with the tokenize
+        and normalize times before it and the counters of parser.stats after it.
+        The backtrace time, when the algorithm reports one, is taken out of the
+        parse time. The parses of a sentence already being timed, such as the
+        fallbacks of mylib.schedule, add to its row instead of making their own.
+        '''
+        if self.active:
+            yield
+            return
+        row = self.row = dict(algo=algo, tokens=len(norm_words), failed=True, **self.row)
+        self.active = True
+        try:
+            yield
+            row["failed"] = False
+        finally:
+            self.row = {}
+            self.active = False
+            counters = {}
+            if parser.stats is not None:
+                for name, value in vars(parser.stats).items():
+                    if name == "backtrace":
+                        row["backtrace"] = value
+                        row["parse"] = row.get("parse", 0.0) - value
+                    elif isinstance(value, int):
+                        counters[name] = value
+            self.add(row, counters)
+
+    def add(self, row, counters):
+        self.sentences += 1
+        self.failures += row["failed"]
+        for phase in PHASES:
+            self.totals[phase] += row.get(phase, 0.0)
+        for name, value in counters.items():
+            self.totals[name] += value
+        if self.metrics is not None:
+            row.update(counters)
+            self.metrics.write(dumps(row) + "\n")
+
+    def close(self):
+        '''
+        Close the metrics file and dump the cProfile.
+        '''
+        if self.metrics is not None:
+            self.metrics.close()
+            self.metrics = None
+        if self.cprofile is not None:
+            self.cprofile.dump_stats(self.pstats)
+            self.cprofile = None
@@ -3,94 +3,641 @@ Extension of
 CKY algorithm from the "Natural Language Processing" course by Michael Collins
 https://class.coursera.org/nlangp-001/class
 """
+import heapq
 from collections import defaultdict
+from json import dumps
 from pprint import pprint
+from time import perf_counter, time
 
-from mylib.tokenizer import PennTreebankTokenizer
-from mylib.earley import Earley
+import numpy as np
 
-def argmax(lst):
-    return max(lst) if lst else (0.0, None)
+from mylib.tokenizer import CompiledPennTreebankTokenizer
+from mylib.eval import ParseError, ParseTimeout
+from mylib.earley import Earley, Beam
+from mylib.vcky import vectorized_CKY
+from mylib.coarse import CoarseToFineStats, prune_chart
+from mylib.kbest import KBestChart
 
-def backtrace(back, bp):
-    # ADD YOUR CODE HERE
+def backtrace(back, bp, symbols):
     # Extract the tree from the backpointers
     if not back:
         return None
     if len(back) == 6:
         (C, C1, C2, Min, Mid, Max) = back
-        return [C, backtrace(bp[Min, Mid, C1], bp),
-                backtrace(bp[Mid+1, Max, C2], bp)]
+        return [symbols[C], backtrace(bp[Min, Mid, C1], bp, symbols),
+                backtrace(bp[Mid+1, Max, C2], bp, symbols)]
+    elif len(back) == 3:
+        # A chain of unary rules, collapsed into one node as in the treebank
+        (C, label, below) = back
+        tree = backtrace(below, bp, symbols)
+        tree[0] = label
+        return tree
     else:
-        (C, C1, Min, Min) = back
-        return [C, C1]
+        (C, word, Min, Min) = back
+        return [symbols[C], word]
+
+def unary_chains(scores, closure, log_space=False):
+    # The symbols X that chains of unary rules X -> ... -> Y build better over
+    # a cell than its scores without them, mapped to (score, Y, label). The
+    # closure has the best chain of every pair, so one step covers chains of
+    # any length. Ties keep the symbol without a chain, then take the largest Y.
+    chains = {}
+    for Y, score in scores.items():
+        for X, p, label in closure[Y]:
+            candidate = (p + score if log_space else p * score, Y, label)
+            if (X not in scores or candidate[0] > scores[X]) and \
+                    (X not in chains or candidate > chains[X]):
+                chains[X] = candidate
+    return chains
+
+class CKYStats():
+    '''
+    The chart cells and edges built while parsing a sentence, and the time of
+    the backtrace
+    '''
+    def __init__(self):
+        self.cells = 0
+        self.edges = 0
+        self.backtrace = 0.0
+
+    def __str__(self):
+        return 'cells: {}, edges: {}'.format(self.cells, self.edges)
+
+def CKY(pcfg, norm_words, log_space=False, threshold=None, span_cache=None, allowed=None,
+        deadline=None, stats=None):
+    # The best tree of the chart of CKY_chart.
+    # stats (a CKYStats) gets the cells and edges of the chart once it is built.
+    pi, bp = CKY_chart(pcfg, norm_words, log_space, threshold, span_cache, allowed, deadline)
+    n = len(norm_words)
+    # Below is one option for retrieving the best trees,
+    # assuming we only want trees with the "S" category
+    # This is a simplification, since not all sentences are of the category "S"
+    # The exact arguments also depends on how you implement your back-pointer chart.
+    # Below it is also assumed that it is called "bp"
+    #return backtrace(bp[1, n, S], bp, grammar.symbols)
+    if stats is not None:
+        stats.cells = sum(1 for cell in pi.values() if cell)
+        stats.edges = sum(len(cell) for cell in pi.values())
+    if not pi[1, n]:
+        raise ParseError('Unable to parse sentence: {}'.format(norm_words))
+    _, top = max((score, C) for C, score in pi[1, n].items())
+    if stats is None:
+        return backtrace(bp[1, n, top], bp, pcfg.compiled.symbols)
+    start = perf_counter()
+    tree = backtrace(bp[1, n, top], bp, pcfg.compiled.symbols)
+    stats.backtrace = perf_counter() - start
+    return tree
 
-def CKY(pcfg, norm_words):
+def CKY_chart(pcfg, norm_words, log_space=False, threshold=None, span_cache=None, allowed=None,
+              deadline=None):
     # NOTE: norm_words is a list of pairs (norm, word), where word is the word
     #       occurring in the input sentence and norm is either the same word,
     #       if it is a known word according to the grammar, or the string _RARE_.
     #       Thus, norm should be used for grammar lookup but word should be used
     #       in the output tree.
+    #       All grammar lookups go through the compiled grammar, so symbols are
+    #       integer ids and only the output tree uses their names.
+    # With log_space, scores are log-probabilities that are added instead of
+    # multiplied, so they cannot underflow on long sentences. threshold (in log
+    # space, e.g. -20) then drops the symbols of a span scoring that far below
+    # the best one of the span.
+    # With a span_cache (a SpanCache), the cells of spans of two words or more
+    # are looked up by the words they cover before they are computed.
+    # allowed (from mylib.coarse.prune_chart) restricts the symbols built over
+    # each span, indexed by [Min-1, Max-1, C]; the span cache is not used then,
+    # since the cells also depend on the rest of the sentence.
+    # Past the deadline (a time() value), the parse stops with a ParseTimeout.
+    # Unary rules between symbols are applied once per cell, through their
+    # closure, after its binary or lexical rules.
+    # Returns the chart pi, mapping a span (Min, Max) to the scores of its
+    # symbols, and the backpointers bp of the best tree of every (Min, Max, C).
+    grammar = pcfg.compiled
+    if log_space:
+        lexical, rules_by_left, zero = grammar.log_lexical, grammar.log_binary_by_left, float('-inf')
+    else:
+        lexical, rules_by_left, zero = grammar.lexical, grammar.binary_by_left, 0.0
+    closure = None
+    if grammar.has_unary_rules:
+        closure = grammar.log_unary_closure if log_space else grammar.unary_closure
 
     # Initialize your charts (for scores and backpointers)
+    # pi maps a span (Min, Max) to the scores of the symbols it can be built as
     x, n = [("", "")] + norm_words, len(norm_words)
-    pi = defaultdict(float)
-    bp = defaultdict(tuple)
+    pi = defaultdict(dict)
+    bp = {}
+
+    ids = [grammar.word_id(norm) for norm, _ in x]
+    if allowed is not None:
+        span_cache = None
+        open_spans = allowed.any(2)
+    if span_cache is not None:
+        span_cache.bind(grammar.fingerprint, log_space, threshold)
 
     # Code for adding the words to the chart
     for Min in range(1, n+1):
-        for C in pcfg.N:
-            norm, word = x[Min]
-            if (C, norm) in pcfg.q1:
-                pi[Min, Min, C] = pcfg.q1[C, norm]
+        word = x[Min][1]
+        w = ids[Min]
+        if w >= 0:
+            ok = allowed[Min-1, Min-1] if allowed is not None else None
+            for C, q in lexical[w].items():
+                if ok is not None and not ok[C]:
+                    continue
+                pi[Min, Min][C] = q
                 bp[Min, Min, C] = (C, word, Min, Min)
+            if closure is not None:
+                cell = pi[Min, Min]
+                for C, (score, Y, label) in unary_chains(cell, closure, log_space).items():
+                    if score > zero and (ok is None or ok[C]):
+                        bp[Min, Min, C], cell[C] = (C, label, (Y, word, Min, Min)), score
     # Code for the dynamic programming part, where larger and larger subtrees are built
+    # Ties are broken on the largest (C1, C2, Mid) as with a max over tuples
     for l in range(1, n):
         for Min in range(1, n-l+1):
+            if deadline is not None and time() > deadline:
+                raise ParseTimeout('Out of time parsing sentence: {}'.format(norm_words))
             Max = Min+l
-            for C in pcfg.N:
-                score, back = argmax([(
-                    pcfg.q2[C, C1, C2] * pi[Min, Mid, C1] * pi[Mid+1, Max, C2],
-                    (C, C1, C2, Min, Mid, Max)
-                    ) for Mid in range(Min, Max)
-                        for C1, C2 in pcfg.binary_rules[C]
-                            if pi[Min, Mid, C1] > 0.0
-                            if pi[Mid+1, Max, C2] > 0.0
-                ])
-
-                if score > 0.0:
-                    bp[Min, Max, C], pi[Min, Max, C] = back, score
-    # Below is one option for retrieving the best trees,
-    # assuming we only want trees with the "S" category
-    # This is a simplification, since not all sentences are of the category "S"
-    # The exact arguments also depends on how you implement your back-pointer chart.
-    # Below it is also assumed that it is called "bp"
-    #return backtrace(bp[0, n, "S"], bp)
-    _, top = max([(pi[1, n, C], bp[1, n, C]) for C in pcfg.N])
-    return backtrace(top, bp)
+            if span_cache is not None:
+                span = tuple(ids[Min:Max+1])
+                cached = span_cache.get(span)
+                if cached is not None:
+                    cell = pi[Min, Max]
+                    for C, entry in cached.items():
+                        if len(entry) == 4:
+                            (score, C1, C2, split) = entry
+                            bp[Min, Max, C], cell[C] = (C, C1, C2, Min, Min+split, Max), score
+                        else:
+                            (score, label, Y, C1, C2, split) = entry
+                            bp[Min, Max, C] = (C, label, (Y, C1, C2, Min, Min+split, Max))
+                            cell[C] = score
+                    continue
+            ok = None
+            if allowed is not None:
+                if not open_spans[Min-1, Max-1]:
+                    continue
+                ok = allowed[Min-1, Max-1].tolist()
+            best = {}
+            for Mid in range(Min, Max):
+                right = pi[Mid+1, Max]
+                for C1, left_score in pi[Min, Mid].items():
+                    for C, C2, q in rules_by_left[C1]:
+                        if C2 in right and (ok is None or ok[C]):
+                            if log_space:
+                                candidate = (q + left_score + right[C2], C1, C2, Mid)
+                            else:
+                                candidate = (q * left_score * right[C2], C1, C2, Mid)
+                            if C not in best or candidate > best[C]:
+                                best[C] = candidate
+
+            cell = pi[Min, Max]
+            floor = zero
+            if log_space and threshold is not None and best:
+                floor = max(best.values())[0] + threshold
+            chains = {}
+            if closure is not None and best:
+                # The floor is that of the binary edges; chains below it are dropped
+                chains = unary_chains({C: entry[0] for C, entry in best.items()}, closure, log_space)
+            for C, (score, C1, C2, Mid) in best.items():
+                if score > zero and score >= floor and C not in chains:
+                    bp[Min, Max, C], cell[C] = (C, C1, C2, Min, Mid, Max), score
+            for C, (score, Y, label) in chains.items():
+                if score > zero and score >= floor and (ok is None or ok[C]):
+                    _, C1, C2, Mid = best[Y]
+                    bp[Min, Max, C], cell[C] = (C, label, (Y, C1, C2, Min, Mid, Max)), score
+            if span_cache is not None:
+                cached = {C: (score, C1, C2, Mid-Min)
+                          for C, (score, C1, C2, Mid) in best.items() if C in cell and C not in chains}
+                for C, (score, Y, label) in chains.items():
+                    if C in cell:
+                        _, C1, C2, Mid = best[Y]
+                        cached[C] = (score, label, Y, C1, C2, Mid-Min)
+                span_cache.put(span, cached)
+    return pi, bp
+
+class AStarStats():
+    '''
+    The number of edges handled while parsing a sentence, and the time of the
+    backtrace
+    '''
+    def __init__(self):
+        self.pushed = 0
+        self.popped = 0
+        self.finished = 0
+        self.backtrace = 0.0
+
+    def __str__(self):
+        return 'edges pushed: {}, popped: {}, finished: {}'.format(
+            self.pushed, self.popped, self.finished)
+
+
+def outside_bounds(grammar, ids, log_space=False):
+    '''
+    Precompute the outside heuristic of a sentence.
+
+    The probability of a tree is the product of its lexical and binary rule
+    probabilities. Outside an edge, every word brings its lexical probability
+    and every preterminal the rule above it. A rule has two children, so
+    giving each child the square root of the best rule it can be a child of
+    never counts more than the rule itself. The outside score of an edge is
+    thus bounded by the best lexical probability times that square root over
+    the words outside it, times the square root for the symbol of the edge,
+    and the bound is consistent: it never grows when going down the tree.
+
+    The context of an edge is bounded too, by CompiledGrammar.outside_estimates
+    for the number of words outside it, and either bound can be used.
+
+    Args:
+        grammar (CompiledGrammar): The grammar.
+        ids (list): The word id of every word, from index 1.
+        log_space (bool): Whether to return log-probabilities.
+
+    Returns:
+        tuple: The bounds of the words before each index and after each index,
+            the bound of every symbol and the context bound of every symbol by
+            number of words outside.
+    '''
+    if log_space:
+        lexical, zero, one = grammar.log_lexical, float('-inf'), 0.0
+        symbol = [p / 2 for p in grammar.log_best_parent_rule]
+    else:
+        lexical, zero, one = grammar.lexical, 0.0, 1.0
+        symbol = [p ** 0.5 for p in grammar.best_parent_rule]
+    n = len(ids) - 1
+    best = [one]
+    for w in ids[1:]:
+        if log_space:
+            best.append(max((q + symbol[T] for T, q in lexical[w].items()), default=zero) if w >= 0 else zero)
+        else:
+            best.append(max((q * symbol[T] for T, q in lexical[w].items()), default=zero) if w >= 0 else zero)
+    before, after = [one] * (n + 2), [one] * (n + 2)
+    for i in range(2, n + 1):
+        before[i] = before[i-1] + best[i-1] if log_space else before[i-1] * best[i-1]
+    for j in range(n - 1, 0, -1):
+        after[j] = after[j+1] + best[j+1] if log_space else after[j+1] * best[j+1]
+    context = grammar.outside_estimates(n)[:n]
+    if log_space:
+        with np.errstate(divide='ignore'):
+            context = np.log(context)
+    return before, after, symbol, context.tolist()
+
+
+def AStar(pcfg, norm_words, log_space=False, stats=None, deadline=None):
+    '''
+    Find the CKY tree of a sentence by best-first search.
+
+    Edges (C, Min, Max) are popped from an agenda in order of their inside score
+    times an admissible and consistent estimate of their outside score, from
+    outside_bounds. An edge popped that way has its best score, so the search
+    stops once an edge covers the sentence.
+    Scores are computed as in CKY and ties are broken the same way, so the tree
+    is the one CKY returns. Unary rules between symbols are not supported: the
+    outside bounds do not hold with them.
+
+    Args:
+        pcfg (PCFG): The grammar.
+        norm_words (list): The (norm, word) pairs of the sentence.
+        log_space (bool): Add log-probabilities instead of multiplying probabilities.
+        stats (AStarStats): Counts the edges pushed, popped and finished.
+        deadline (float): The time() past which the search stops, or None.
+
+    Returns:
+        list: The tree.
+
+    Raises:
+        ParseError: If the sentence has no parse.
+        ParseTimeout: If the deadline passes first.
+        ValueError: If the grammar has unary rules between symbols.
+    '''
+    grammar = pcfg.compiled
+    if grammar.has_unary_rules:
+        raise ValueError('A* does not support unary rules between symbols')
+    stats = stats if stats is not None else AStarStats()
+    if log_space:
+        lexical, by_left, by_right = grammar.log_lexical, grammar.log_binary_by_left, grammar.log_binary_by_right
+        by_children, zero = grammar.log_binary_by_children, float('-inf')
+    else:
+        lexical, by_left, by_right = grammar.lexical, grammar.binary_by_left, grammar.binary_by_right
+        by_children, zero = grammar.binary_by_children, 0.0
+
+    x, n = [("", "")] + norm_words, len(norm_words)
+    ids = [grammar.word_id(norm) for norm, _ in x]
+    before, after, symbol, context = outside_bounds(grammar, ids, log_space)
+
+    # cells maps a span to the best (score, C1, C2, Mid) of each symbol so far
+    # and done to the scores of its finished edges, which are also reached from
+    # where they start and end: starts[Min][Max] = ends[Max][Min] = done[Min, Max]
+    cells = defaultdict(dict)
+    done = defaultdict(dict)
+    bp = {}
+    starts = [{} for _ in range(n + 2)]
+    ends = [{} for _ in range(n + 2)]
+    agenda = []
+
+    def push(C, Min, Max, score):
+        if Min == 1 and Max == n:
+            priority = score
+        elif log_space:
+            priority = score + min(before[Min] + after[Max] + symbol[C], context[n-1-Max+Min][C])
+        else:
+            priority = score * min(before[Min] * after[Max] * symbol[C], context[n-1-Max+Min][C])
+        if priority > zero:
+            stats.pushed += 1
+            # Shorter edges first on ties, so the children of an edge come before it
+            heapq.heappush(agenda, (-priority, Max - Min, Min, C))
+
+    def improve(C, Min, Max, candidate):
+        # candidate beats the best (score, C1, C2, Mid) of the edge so far
+        back = (C, candidate[1], candidate[2], Min, candidate[3], Max)
+        if C in done[Min, Max]:
+            # Already finished: a candidate can only tie, take its backpointer as CKY would
+            if candidate[0] == cells[Min, Max][C][0]:
+                cells[Min, Max][C], bp[Min, Max, C] = candidate, back
+            return
+        cells[Min, Max][C], bp[Min, Max, C] = candidate, back
+        push(C, Min, Max, candidate[0])
+
+    for Min in range(1, n+1):
+        word = x[Min][1]
+        if ids[Min] >= 0:
+            for C, q in lexical[ids[Min]].items():
+                cells[Min, Min][C] = (q,)
+                bp[Min, Min, C] = (C, word, Min, Min)
+                push(C, Min, Min, q)
+
+    goal = None
+    while agenda:
+        priority, length, Min, C = heapq.heappop(agenda)
+        stats.popped += 1
+        if goal is not None and -priority < goal:
+            break
+        Max = Min + length
+        finished = done[Min, Max]
+        if C in finished:
+            continue
+        if deadline is not None and time() > deadline:
+            raise ParseTimeout('Out of time parsing sentence: {}'.format(norm_words))
+        score = cells[Min, Max][C][0]
+        stats.finished += 1
+        finished[C] = score
+        starts[Min][Max] = ends[Max][Min] = finished
+        if Min == 1 and Max == n:
+            # Keep popping the edges tied with the first parse, to break the tie as CKY
+            goal = score if goal is None else goal
+            continue
+
+        # C as the left child of the finished edges starting after it, going
+        # through the rules or through the edges, whichever are fewer
+        rules = by_left[C]
+        for End, right in starts[Max+1].items():
+            cell = cells[Min, End]
+            if len(right) < len(rules):
+                pairs = ((P, C2, q) for C2 in right for P, q in by_children.get((C, C2), ()))
+            else:
+                pairs = rules
+            for P, C2, q in pairs:
+                if C2 in right:
+                    if log_space:
+                        candidate = (q + score + right[C2], C, C2, Max)
+                    else:
+                        candidate = (q * score * right[C2], C, C2, Max)
+                    if P not in cell or candidate > cell[P]:
+                        improve(P, Min, End, candidate)
+        # C as the right child of the finished edges ending before it
+        rules = by_right[C]
+        for Start, left in ends[Min-1].items():
+            cell = cells[Start, Max]
+            if len(left) < len(rules):
+                pairs = ((P, C1, q) for C1 in left for P, q in by_children.get((C1, C), ()))
+            else:
+                pairs = rules
+            for P, C1, q in pairs:
+                if C1 in left:
+                    if log_space:
+                        candidate = (q + left[C1] + score, C1, C, Min-1)
+                    else:
+                        candidate = (q * left[C1] * score, C1, C, Min-1)
+                    if P not in cell or candidate > cell[P]:
+                        improve(P, Start, Max, candidate)
+
+    if goal is None:
+        raise ParseError('Unable to parse sentence: {}'.format(norm_words))
+    _, top = max((score, C) for C, score in done[1, n].items())
+    start = perf_counter()
+    tree = backtrace(bp[1, n, top], bp, grammar.symbols)
+    stats.backtrace = perf_counter() - start
+    return tree
+
+def flat_tree(pcfg, norm_words, root="S"):
+    # A right-branching tree over the most probable tag of every word, for the
+    # sentences no parser can afford: [root, [T1, w1], [root|T1, [T2, w2], ...]]
+    grammar = pcfg.compiled
+    tags = []
+    for norm, word in norm_words:
+        w = grammar.word_id(norm)
+        if w < 0 or not grammar.lexical[w]:
+            raise ParseError('Unable to tag word: {}'.format(word))
+        _, C = max((q, C) for C, q in grammar.lexical[w].items())
+        tags.append([grammar.symbols[C], word])
+    if not tags:
+        raise ParseError('Unable to parse an empty sentence')
+    tree = tags[-1]
+    for i in range(len(tags) - 2, -1, -1):
+        tree = [root if i == 0 else root + "|" + tags[i-1][0], tags[i], tree]
+    return tree
 
 class Parser:
     def __init__(self, pcfg):
         self.pcfg = pcfg
-        self.tokenizer = PennTreebankTokenizer()
+        self.tokenizer = CompiledPennTreebankTokenizer()
+        self.beam = Beam()
+        self.stats = None
+        self.log_space = False
+        self.threshold = None
+        self.coarse_threshold = None
+        self.cache = None
+        self.span_cache = None
+        # The time() past which a parse stops with a ParseTimeout, set per
+        # sentence by mylib.schedule; it is not a setting since it does not
+        # change the trees that are found in time
+        self.deadline = None
+        # A mylib.metrics.ParseProfiler to time and count every sentence, or None
+        self.profiler = None
+
+    def settings(self):
+        # The tunables of the parser, to set up another parser the same way
+        return {"beam": self.beam, "log_space": self.log_space, "threshold": self.threshold,
+                "coarse_threshold": self.coarse_threshold}
+
+    def configure(self, **settings):
+        for name, value in settings.items():
+            if name not in self.settings():
+                raise ValueError("Unknown parser setting: {}".format(name))
+            setattr(self, name, value)
+
+    def normalize_word(self, word):
+        # The (norm, word) pair of a token: rare words normalization + keep word
+        return self.pcfg.lexicon.normalize([word])[0]
 
     def normalize_sentence(self, sentence):
-        words = self.tokenizer.tokenize(sentence)
-        norm_words = []
-        for word in words:                # rare words normalization + keep word
-            norm_words.append((self.pcfg.norm_word(word), word))
-        return norm_words
+        if self.profiler is not None:
+            words = self.profiler.timed("tokenize", self.tokenizer.tokenize, sentence)
+            return self.profiler.timed("normalize", self.normalize_words, words)
+        return self.normalize_words(self.tokenizer.tokenize(sentence))
 
-    def parse_CKY(self, sentence):
-        tree = CKY(self.pcfg, self.normalize_sentence(sentence))
+    def normalize_words(self, words):
+        return self.pcfg.lexicon.normalize(words)
+
+    def parse(self, algo, norm_words, parse):
+        if self.profiler is None:
+            return self.__parse(algo, norm_words, parse)
+        with self.profiler.sentence(self, algo, norm_words):
+            return self.profiler.timed("parse", self.__parse, algo, norm_words, parse)
+
+    def __parse(self, algo, norm_words, parse):
+        # Parse the normalized sentence with parse, unless the cache has the tree
+        if self.cache is None:
+            tree = parse(norm_words)
+        else:
+            key = self.cache.key(self.pcfg.compiled.fingerprint, algo, self.settings(), norm_words)
+            found, tree = self.cache.get(key)
+            if not found:
+                try:
+                    tree = parse(norm_words)
+                except ParseTimeout:
+                    raise
+                except ParseError:
+                    self.cache.put(key, None)
+                    raise
+                self.cache.put(key, tree)
+            elif tree is None:
+                raise ParseError('Unable to parse sentence: {}'.format(norm_words))
         tree[0] = tree[0].split("|")[0]
         return tree
 
+    def parse_words(self, algo, norm_words):
+        # Parse the (norm, word) pairs of normalize_sentence with algo, as
+        # parse_<algo> parses a sentence; mylib.schedule tries the fallbacks of
+        # a sentence this way without tokenizing it again
+        parse = {"CKY": self.__parse_CKY, "NumpyCKY": self.__parse_NumpyCKY,
+                 "Earley": self.__parse_Earley, "AStar": self.__parse_AStar,
+                 "Flat": self.__parse_Flat}.get(algo)
+        if parse is None:
+            raise ValueError("Unknown parsing algorithm: {}".format(algo))
+        return parse(norm_words)
+
+    def parse_CKY(self, sentence):
+        return self.__parse_CKY(self.normalize_sentence(sentence))
+
+    def __parse_CKY(self, norm_words):
+        self.stats = None
+        if self.coarse_threshold is not None:
+            self.stats = CoarseToFineStats()
+            return self.parse("CKY", norm_words, self.__coarse_to_fine)
+        if self.profiler is not None:
+            self.stats = CKYStats()
+        return self.parse("CKY", norm_words,
+                          lambda norm_words: CKY(self.pcfg, norm_words, self.log_space, self.threshold,
+                                                 self.span_cache, deadline=self.deadline,
+                                                 stats=self.stats))
+
+    def __coarse_to_fine(self, norm_words):
+        # Parse with the cells the coarse pass keeps, or with all of them if
+        # the pruning leaves no parse
+        allowed = prune_chart(self.pcfg, norm_words, self.coarse_threshold, self.stats)
+        if allowed is not None:
+            try:
+                return CKY(self.pcfg, norm_words, self.log_space, self.threshold, allowed=allowed,
+                           deadline=self.deadline)
+            except ParseTimeout:
+                raise
+            except ParseError:
+                pass
+        self.stats.fallbacks += 1
+        return CKY(self.pcfg, norm_words, self.log_space, self.threshold, self.span_cache,
+                   deadline=self.deadline)
+
+    def parse_kbest(self, sentence, k):
+        # The k most probable CKY trees of the sentence, best first, as (tree,
+        # probability) pairs, log-probabilities with log_space. They come from
+        # the whole chart, without coarse-to-fine pruning, and the parse cache
+        # is not used since it keeps one tree per sentence. Derivations that
+        # only differ by the X|... symbol at the root give the same tree, which
+        # is only returned once.
+        if k < 1:
+            raise ValueError('k must be at least 1, not {}'.format(k))
+        self.stats = None
+        norm_words = self.normalize_sentence(sentence)
+        if self.profiler is None:
+            return self.__kbest(norm_words, k)
+        with self.profiler.sentence(self, "KBest", norm_words):
+            return self.profiler.timed("parse", self.__kbest, norm_words, k)
+
+    def __kbest(self, norm_words, k):
+        pi, _ = CKY_chart(self.pcfg, norm_words, self.log_space, self.threshold, self.span_cache,
+                          deadline=self.deadline)
+        trees, seen = [], set()
+        for tree, score in KBestChart(self.pcfg.compiled, pi, norm_words, self.log_space).trees():
+            tree[0] = tree[0].split("|")[0]
+            key = dumps(tree)
+            if key not in seen:
+                seen.add(key)
+                trees.append((tree, score))
+                if len(trees) == k:
+                    break
+        if not trees:
+            raise ParseError('Unable to parse sentence: {}'.format(norm_words))
+        return trees
+
+    def parse_NumpyCKY(self, sentence):
+        return self.__parse_NumpyCKY(self.normalize_sentence(sentence))
+
+    def __parse_NumpyCKY(self, norm_words):
+        self.stats = None
+        return self.parse("NumpyCKY", norm_words,
+                          lambda norm_words: vectorized_CKY(self.pcfg.compiled, norm_words,
+                                                            self.log_space, self.threshold,
+                                                            self.deadline))
+
     def parse_Earley(self, sentence):
-        earley = Earley(self.pcfg, self.normalize_sentence(sentence))
-        tree = earley.parse()
-        tree[0] = tree[0].split("|")[0]
-        return tree
+        return self.__parse_Earley(self.normalize_sentence(sentence))
+
+    def __parse_Earley(self, norm_words):
+        self.stats = None
+        return self.parse("Earley", norm_words, self.__earley)
+
+    def start_Earley(self):
+        # An Earley parser fed one normalized token at a time, e.g.
+        #   earley = parser.start_Earley()
+        #   for token in tokens:
+        #       if not earley.feed(parser.normalize_word(token)): break
+        #   tree, prob, complete = earley.current_best()
+        earley = Earley(self.pcfg, [], self.beam, self.log_space)
+        self.stats = earley.stats
+        return earley
+
+    def parse_AStar(self, sentence):
+        return self.__parse_AStar(self.normalize_sentence(sentence))
+
+    def __parse_AStar(self, norm_words):
+        # A* cannot apply unary rules, and CKY finds the same tree as it would
+        if self.pcfg.compiled.has_unary_rules:
+            return self.__parse_CKY(norm_words)
+        self.stats = AStarStats()
+        return self.parse("AStar", norm_words,
+                          lambda norm_words: AStar(self.pcfg, norm_words, self.log_space, self.stats,
+                                                   self.deadline))
+
+    def parse_Flat(self, sentence):
+        # A right-branching tree over the best tags, the fallback of mylib.schedule
+        return self.__parse_Flat(self.normalize_sentence(sentence))
+
+    def __parse_Flat(self, norm_words):
+        self.stats = None
+        return self.parse("Flat", norm_words, lambda norm_words: flat_tree(self.pcfg, norm_words))
+
+    def __earley(self, norm_words):
+        earley = Earley(self.pcfg, norm_words, self.beam, self.log_space)
+        self.stats = earley.stats
+        return earley.parse(self.deadline)
 
 def display_tree(tree):
     pprint(tree)
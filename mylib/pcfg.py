@@ -1,9 +1,16 @@
+import os
 from collections import Counter, defaultdict
 from json import loads, dumps
 
+from mylib import grammar
+from mylib.extract import COUNTS_VERSION, count_treebank, treebank_digest
+from mylib.grammar import CompiledGrammar, Lexicon
+
 
 class PCFG:
     RARE_WORD_COUNT = 5
+    # The rule dicts, which load_compiled only rebuilds when they are used
+    RULE_TABLES = ('q1', 'q2', 'q3', 'N', 'unary_rules', 'binary_rules')
 
     def __init__(self):
         self.q1 = defaultdict(float)
@@ -11,10 +18,46 @@ class PCFG:
         self.q3 = defaultdict(float)
         self.well_known_words = set()
 
+    def __getattr__(self, name):
+        if name in PCFG.RULE_TABLES and 'compiled' in self.__dict__:
+            self.__expand()
+            return self.__dict__[name]
+        if name == 'lexicon' and 'compiled' in self.__dict__:
+            # The known words interned with their word ids, built when a
+            # sentence is first normalized rather than with the grammar
+            self.lexicon = Lexicon(self.well_known_words, self.compiled)
+            return self.lexicon
+        raise AttributeError(name)
+
+    def __expand(self):
+        compiled = self.compiled
+        self.q1 = defaultdict(float)
+        self.q2 = defaultdict(float)
+        self.q3 = defaultdict(float)
+        symbols, words = compiled.symbols, compiled.words
+        for word in range(len(words)):
+            lo, hi = compiled.word_offsets[word], compiled.word_offsets[word + 1]
+            for x, p in zip(compiled.lex_symbol[lo:hi].tolist(), compiled.lex_prob[lo:hi].tolist()):
+                self.q1[symbols[x], words[word]] = p
+        for x, y1, y2, p in zip(compiled.rule_parent.tolist(), compiled.rule_left.tolist(),
+                                compiled.rule_right.tolist(), compiled.rule_prob.tolist()):
+            self.q2[symbols[x], symbols[y1], symbols[y2]] = p
+        for x, y1, p in zip(compiled.unary_parent.tolist(), compiled.unary_child.tolist(),
+                            compiled.unary_prob.tolist()):
+            self.q3[symbols[x], symbols[y1]] = p
+        self.__build_caches(compile=False)
+
+    def coarse_grammar(self):
+        # The grammar with the X|... symbols of the binarization projected onto X,
+        # and the coarse id of every symbol, built the first time it is needed
+        if 'coarse' not in self.__dict__:
+            self.coarse = self.compiled.project(lambda sym: sym.split("|")[0])
+        return self.coarse
+
     def norm_word(self, word):
         return word if word in self.well_known_words else "_RARE_" #word_class(word)
 
-    def __build_caches(self):
+    def __build_caches(self, compile=True):
         self.N = set()
         self.unary_rules = defaultdict(list)
         self.binary_rules = defaultdict(list)
@@ -29,17 +72,38 @@ class PCFG:
 
         for x, y1 in self.q3.keys():
             self.N.update(set([x, y1]))
-            #self.unary_rules[x].append((y1))
-
-
-    def learn_from_treebank(self, treebank):
-        self.sym_count = Counter()
-        self.unary_count = Counter()
-        self.binary_count = Counter()
-        self.words_count = Counter()
 
-        for s in open(treebank):
-            self.count(loads(s))
+        if compile:
+            self.compiled = CompiledGrammar(self.q1, self.q2, self.q3)
+            self.__dict__.pop('lexicon', None)
+            self.__dict__.pop('coarse', None)
+
+
+    def learn_from_treebank(self, treebank, workers=1, cache_dir=None):
+        # Count the treebank with that many processes, then estimate the rules.
+        # With a cache_dir, the grammar is saved there under the hash of the
+        # treebank, RARE_WORD_COUNT and COUNTS_VERSION, and loaded from there
+        # the next time.
+        if cache_dir is not None:
+            cached = os.path.join(cache_dir, '{}-{}-v{}.dat'.format(
+                treebank_digest(treebank), PCFG.RARE_WORD_COUNT, COUNTS_VERSION))
+            if os.path.exists(cached):
+                self.load_model(cached)
+                return
+        self.learn_from_counts(count_treebank(treebank, workers))
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Written aside first, so an interrupted save leaves no partial grammar
+            self.save_model(cached + '.tmp')
+            os.replace(cached + '.tmp', cached)
+
+    def learn_from_counts(self, counts):
+        # Estimate the rules from the counts (a TreebankCounts) of a treebank
+        self.sym_count = counts.sym_count
+        self.unary_count = counts.unary_count
+        self.unary_rule_count = counts.unary_rule_count
+        self.binary_count = counts.binary_count
+        self.words_count = counts.words_count
 
         # Words
         for word, count in self.words_count.items():
@@ -60,34 +124,12 @@ class PCFG:
         for (x, y1, y2), count in self.binary_count.items():
             self.q2[x, y1, y2] = self.binary_count[x, y1, y2] / self.sym_count[x]
 
-        # Q3 currently not handled
+        # Q3
+        for (x, y1), count in self.unary_rule_count.items():
+            self.q3[x, y1] = count / self.sym_count[x]
 
         self.__build_caches()
 
-    def count(self, tree):
-        # Base case: terminal symbol
-        if isinstance(tree, str):
-            return
-
-        # Count the non-terminal symbols
-        sym = tree[0]
-        self.sym_count[sym] += 1
-
-        if len(tree) == 3:
-            # Binary Rule
-            y1, y2 = (tree[1][0], tree[2][0])
-            self.binary_count[(sym, y1, y2)] += 1
-
-            # Recursively count the children
-            self.count(tree[1])
-            self.count(tree[2])
-
-        elif len(tree) == 2:
-            # Unary Rule
-            word = tree[1]
-            self.unary_count[(sym, word)] += 1
-            self.words_count[word] += 1
-
 
     def save_model(self, path):
         with open(path, 'w') as model:
@@ -97,7 +139,8 @@ class PCFG:
             for (x, y1, y2), p in self.q2.items():
                 model.write(dumps(['Q2', x, y1, y2, p]) + '\n')
 
-            # Q3 currently not handled
+            for (x, y1), p in self.q3.items():
+                model.write(dumps(['Q3', x, y1, p]) + '\n')
 
             model.write(dumps(['WORDS', list(self.well_known_words)]) + '\n')
 
@@ -119,6 +162,22 @@ class PCFG:
                     self.q3[x, y1] = p
 
                 elif data[0] == 'WORDS':
-                    self.well_known_words = data[1]
+                    self.well_known_words = set(data[1])
 
         self.__build_caches()
+
+    def save_compiled(self, path):
+        grammar.save_compiled(path, self.compiled, self.well_known_words)
+
+    def load_compiled(self, path):
+        self.compiled, known_words = grammar.load_compiled(path)
+        self.well_known_words = set(known_words)
+        for name in PCFG.RULE_TABLES + ('coarse', 'lexicon'):
+            self.__dict__.pop(name, None)
+
+    def load(self, path):
+        # Load a grammar saved with either save_model or save_compiled
+        if grammar.is_compiled(path):
+            self.load_compiled(path)
+        else:
+            self.load_model(path)
@@ -0,0 +1,101 @@
+'''
+A module that chains reading, parsing, scoring and writing as generators, so a
+corpus of any size is processed one sentence at a time.
+'''
+
+import warnings
+from json import dumps, loads
+
+from mylib.bulk import parallel_parse
+from mylib.eval import ParseError
+
+
+def read_trees(lines):
+    '''
+    Read one JSON tree per line.
+    '''
+    for line in lines:
+        yield loads(line)
+
+
+def parse_sentences(parser, algo, sentences):
+    '''
+    Parse sentences one by one.
+
+    Args:
+        parser (Parser): The parser.
+        algo (str): The parsing algorithm, e.g. "CKY" or "Earley".
+        sentences (iterable): The sentences, one per item.
+
+    Yields:
+        tuple: The (line index, tree, failed) triple of every sentence. A
+            sentence that fails gets the tree [''].
+    '''
+    parse = getattr(parser, "parse_" + algo)
+    for idx, sentence in enumerate(sentences):
+        try:
+            yield idx, parse(sentence), False
+        except ParseError:
+            yield idx, [''], True
+
+
+def parse_stream(parser, algo, sentences, workers=1, grammar_file=None, stats=None):
+    '''
+    Parse sentences in order, in this process or with a pool of workers.
+
+    Args:
+        parser (Parser): The parser.
+        algo (str): The parsing algorithm, e.g. "CKY" or "Earley".
+        sentences (iterable): The sentences, one per item.
+        workers (int): The number of worker processes, 1 to parse in this process.
+        grammar_file (str): The grammar, for workers that cannot be forked.
+        stats (WorkerStats): Collects the statistics of every worker.
+    '''
+    if workers > 1:
+        return parallel_parse(parser, algo, sentences, workers,
+                              grammar_file=grammar_file, stats=stats)
+    return parse_sentences(parser, algo, sentences)
+
+
+def evaluate(results, gold_trees, evaluator):
+    '''
+    Score the parses against the gold trees as they go by.
+
+    Failed parses are scored as predicting no constituent, as ParseEvaluator
+    scores their [''] trees offline. The results are passed on unchanged, all
+    of them even if there are fewer gold trees, and a warning tells when there
+    are not as many gold trees as results.
+
+    Args:
+        results (iterable): The (line index, tree, failed) triples.
+        gold_trees (iterable): The gold tree of every line.
+        evaluator (ParseEvaluator): The evaluator to update.
+    '''
+    gold_trees = iter(gold_trees)
+    sentences = scored = 0
+    for idx, tree, failed in results:
+        sentences += 1
+        gold = next(gold_trees, None)
+        if gold is not None:
+            scored += 1
+            evaluator.add(gold, tree)
+        yield idx, tree, failed
+    extra = sum(1 for _ in gold_trees)
+    if scored < sentences or extra:
+        warnings.warn('{} sentences but {} gold trees, only the first {} parses are scored'.format(
+            sentences, scored + extra, scored))
+
+
+def write_trees(results, output):
+    '''
+    Write one JSON tree per line.
+
+    Returns:
+        tuple: The number of sentences written and of failed parses.
+    '''
+    written = failures = 0
+    for _, tree, failed in results:
+        output.write(dumps(tree) + "\n")
+        written += 1
+        failures += failed
+    return written, failures
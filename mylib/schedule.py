@@ -0,0 +1,144 @@
+'''
+A module that keeps what a sentence can cost a bulk parse within a budget, and
+reports what the sentences cost by length.
+
+CKY takes O(n^3 |G|) on a sentence of n tokens, so a few long sentences can take
+longer than the rest of a corpus. A sentence that runs out of its budget is
+parsed again by cheaper strategies instead: CKY in log space with a narrow beam,
+then a right-branching tree over the best tags, which always succeeds.
+'''
+
+from collections import Counter, defaultdict
+from contextlib import nullcontext
+from time import time
+
+from mylib.eval import ParseError, ParseTimeout
+
+# The strategy of the trees that failed
+FAILED = "failed"
+
+
+class Budget():
+    '''
+    The most a sentence may cost before the fallbacks parse it instead
+    '''
+    def __init__(self, seconds=None, cells=None, threshold=-8.0):
+        '''
+        Initialize a budget.
+
+        Args:
+            seconds (float): The time each strategy has for a sentence, or None for no limit.
+            cells (int): The largest chart, in spans (n (n + 1) / 2 for n tokens), to
+                parse with the requested algorithm; larger sentences go straight to
+                the fallbacks. None for no limit.
+            threshold (float): The beam of the CKY fallback: the symbols of a span
+                scoring that much below the best one, in log space, are dropped.
+        '''
+        self.seconds = seconds
+        self.cells = cells
+        self.threshold = threshold
+
+    def __str__(self):
+        return 'seconds={} cells={} threshold={}'.format(self.seconds, self.cells, self.threshold)
+
+    def affords(self, tokens):
+        '''
+        Check whether the chart of a sentence of that many tokens is within the budget.
+        '''
+        return self.cells is None or tokens * (tokens + 1) // 2 <= self.cells
+
+
+def within(parser, algo, norm_words, seconds):
+    # Parse the normalized words with algo, stopping after seconds unless it is None
+    parser.deadline = time() + seconds if seconds is not None else None
+    try:
+        return parser.parse_words(algo, norm_words)
+    finally:
+        parser.deadline = None
+
+
+def parse_scheduled(parser, algo, sentence, budget=None):
+    '''
+    Parse a sentence with algo, or with the fallbacks when it is over budget.
+
+    Args:
+        parser (Parser): The parser.
+        algo (str): The parsing algorithm, e.g. "CKY" or "Earley".
+        sentence (str): The sentence.
+        budget (Budget): The budget of the sentence, or None for no limit.
+
+    Returns:
+        tuple: The tree, whether the parse failed, and the (tokens, seconds,
+            strategy) cost of the sentence. The strategy is algo, "Beam" or "Flat"
+            for the fallbacks, or FAILED; a sentence that fails gets the tree [''].
+    '''
+    start = time()
+    # Normalized once, for every strategy the sentence may need
+    norm_words = parser.normalize_sentence(sentence)
+    tokens = len(norm_words)
+    tree, strategy = [''], FAILED
+    # A profiler counts the sentence once, whatever strategies it takes
+    if parser.profiler is not None:
+        profiled = parser.profiler.sentence(parser, algo, norm_words)
+    else:
+        profiled = nullcontext()
+    try:
+        with profiled:
+            if budget is None:
+                tree, strategy = within(parser, algo, norm_words, None), algo
+            else:
+                tree, strategy = parse_fallback(parser, algo, norm_words, budget)
+    except ParseError:
+        pass
+    return tree, strategy == FAILED, (tokens, time() - start, strategy)
+
+
+def parse_fallback(parser, algo, norm_words, budget):
+    # The tree and strategy of a normalized sentence within budget. Only
+    # running out of time or chart moves on to the fallbacks: a sentence algo
+    # cannot parse fails as it does without a budget.
+    if budget.affords(len(norm_words)):
+        try:
+            return within(parser, algo, norm_words, budget.seconds), algo
+        except ParseTimeout:
+            pass
+    settings = parser.settings()
+    parser.configure(log_space=True, threshold=budget.threshold)
+    try:
+        return within(parser, "CKY", norm_words, budget.seconds), "Beam"
+    except ParseError:
+        pass
+    finally:
+        parser.configure(**settings)
+    return parser.parse_words("Flat", norm_words), "Flat"
+
+
+class LengthStats():
+    '''
+    The parse time of the sentences by length, and the strategies that parsed them
+    '''
+    def __init__(self, bucket=10):
+        self.bucket = bucket
+        self.seconds = defaultdict(list)
+        self.strategies = defaultdict(Counter)
+
+    def add(self, tokens, seconds, strategy):
+        b = tokens // self.bucket
+        self.seconds[b].append(seconds)
+        self.strategies[b][strategy] += 1
+
+    def output(self, algo, file=None):
+        '''
+        Print the time percentiles of every length bucket, and how many of its
+        sentences were left to the fallbacks or failed.
+        '''
+        print("%10s  %10s  %8s  %8s  %8s  %8s  %10s  %8s" % (
+            "Tokens", "Sentences", "Mean", "p50", "p90", "Max", "Fallbacks", "Failed"), file=file)
+        for b in sorted(self.seconds):
+            seconds = sorted(self.seconds[b])
+            count, strategies = len(seconds), self.strategies[b]
+            fallbacks = count - strategies[algo] - strategies[FAILED]
+            print("%10s  %10d  %7.3fs  %7.3fs  %7.3fs  %7.3fs  %10d  %8d" % (
+                "%d-%d" % (b * self.bucket, (b + 1) * self.bucket - 1), count, sum(seconds) / count,
+                seconds[count // 2], seconds[min(count - 1, count * 9 // 10)], seconds[-1],
+                fallbacks, strategies[FAILED]), file=file)
@@ -0,0 +1,201 @@
+'''
+A module that keeps a warm parser around and serves parse requests, from the
+prompt or as JSON over HTTP on a local port.
+'''
+
+import json
+import multiprocessing
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import time
+
+from mylib.bulk import init_worker, parse_chunk
+from mylib.parser import Parser
+from mylib.pipeline import parse_sentences
+
+
+class LatencyStats():
+    '''
+    The latencies of the most recent requests, and their percentiles
+    '''
+    def __init__(self, size=10000):
+        self.count = 0
+        self.samples = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.count += 1
+            self.samples.append(seconds)
+
+    def percentiles(self, points=(50, 90, 99)):
+        '''
+        Get latency percentiles, in seconds, over the recorded samples.
+
+        Returns:
+            dict: The number of requests and a "pN" entry for every percentile,
+                plus the maximum.
+        '''
+        with self.lock:
+            samples = sorted(self.samples)
+            result = {"count": self.count}
+        for p in points:
+            result["p%d" % p] = samples[min(len(samples) - 1, len(samples) * p // 100)] if samples else 0.0
+        result["max"] = samples[-1] if samples else 0.0
+        return result
+
+    def output(self, name, file=None):
+        stats = self.percentiles()
+        print("%-10s requests: %d  p50: %.3fs  p90: %.3fs  p99: %.3fs  max: %.3fs" % (
+            name, stats["count"], stats["p50"], stats["p90"], stats["p99"], stats["max"]), file=file)
+
+
+class ParserService():
+    '''
+    A ParserService parses batches of sentences with an already loaded parser.
+
+    Requests wait in a bounded queue and are taken by one thread per worker. With
+    more than one worker the sentences are parsed by a pool of processes forked
+    from this one, which share the grammar.
+
+    The service parses with a Parser of its own, since the stats and deadline of
+    a parser change with every sentence, so the one it is given can still be
+    used meanwhile. It has the same grammar, settings and parse cache, but no
+    span cache or profiler, which are not shared between threads.
+    '''
+    def __init__(self, parser, algo, workers=1, queue_size=64):
+        '''
+        Initialize the service and start its workers.
+
+        Args:
+            parser (Parser): The parser to parse like, with its grammar loaded.
+            algo (str): The parsing algorithm, e.g. "CKY" or "Earley".
+            workers (int): The number of requests parsed at the same time.
+            queue_size (int): The number of requests that can wait.
+        '''
+        self.parser = Parser(parser.pcfg)
+        self.parser.configure(**parser.settings())
+        self.parser.cache = parser.cache
+        self.algo = algo
+        self.workers = workers
+        self.latency = LatencyStats()
+        self.requests = queue.Queue(queue_size)
+        self.pool = None
+        if workers > 1:
+            self.pool = multiprocessing.get_context('fork').Pool(
+                workers, initializer=init_worker, initargs=(self.parser, algo))
+        self.threads = [threading.Thread(target=self.__work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, sentences):
+        '''
+        Queue a batch of sentences.
+
+        Args:
+            sentences (list): The sentences to parse.
+
+        Returns:
+            Future: Resolves to the (line index, tree, failed) triple of every sentence.
+
+        Raises:
+            queue.Full: If too many requests are already waiting.
+        '''
+        future = Future()
+        self.requests.put_nowait((time(), list(sentences), future))
+        return future
+
+    def parse(self, sentences):
+        '''
+        Parse a batch of sentences and wait for the result.
+        '''
+        return self.submit(sentences).result()
+
+    def __work(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            start, sentences, future = request
+            try:
+                if self.pool is not None:
+                    _, _, results, _ = self.pool.apply(parse_chunk, (list(enumerate(sentences)),))
+                else:
+                    results = list(parse_sentences(self.parser, self.algo, sentences))
+            except Exception as error:
+                future.set_exception(error)
+            else:
+                future.set_result(results)
+            self.latency.add(time() - start)
+
+    def stats(self):
+        stats = self.latency.percentiles()
+        stats.update(algo=self.algo, workers=self.workers, queued=self.requests.qsize())
+        return stats
+
+    def close(self):
+        for _ in self.threads:
+            self.requests.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.pool is not None:
+            self.pool.terminate()
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    '''
+    The HTTP endpoints of a ParserService:
+
+        POST /parse  {"sentences": ["...", ...]} -> {"trees": [...], "failed": [...]}
+        GET  /stats  -> the latency percentiles and queue length
+    '''
+    service = None
+
+    def do_POST(self):
+        if self.path != "/parse":
+            return self.__reply(404, {"error": "unknown endpoint " + self.path})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            sentences = request["sentences"] if "sentences" in request else [request["sentence"]]
+            if not isinstance(sentences, list) or not all(isinstance(s, str) for s in sentences):
+                raise TypeError("sentences must be a list of strings")
+        except (ValueError, KeyError, TypeError):
+            return self.__reply(400, {"error": 'expected {"sentences": [...]}'})
+        try:
+            results = self.service.parse(sentences)
+        except queue.Full:
+            return self.__reply(503, {"error": "too many requests waiting"})
+        self.__reply(200, {"trees": [tree for _, tree, _ in results],
+                           "failed": [failed for _, _, failed in results]})
+
+    def do_GET(self):
+        if self.path != "/stats":
+            return self.__reply(404, {"error": "unknown endpoint " + self.path})
+        self.__reply(200, self.service.stats())
+
+    def __reply(self, code, body):
+        body = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(service, host="127.0.0.1", port=8080):
+    '''
+    Serve a ParserService over HTTP from a background thread.
+
+    Returns:
+        ThreadingHTTPServer: The server; call shutdown() to stop it.
+    '''
+    handler = type("Handler", (ServiceHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
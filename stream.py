@@ -0,0 +1,63 @@
+import argparse
+from sys import stdin, stdout, stderr
+from time import time
+
+from mylib.pcfg import PCFG
+from mylib.parser import Parser
+from mylib.eval import ParseEvaluator
+from mylib.bulk import WorkerStats
+from mylib.pipeline import parse_stream, read_trees, evaluate, write_trees
+
+'''
+Non-interactive parsing: sentences are read from a file or stdin one line at a
+time and one tree per line is written out, so memory stays the same whatever
+the size of the corpus.
+
+    python3 stream.py data/train_grammar.dat data/dev.raw -o dev.out --gold data/dev_cnf.dat
+    cat data/dev.raw | python3 stream.py data/train_grammar.dat --algo NumpyCKY
+'''
+
+
+def main(argv=None):
+    args = argparse.ArgumentParser(description="Parse sentences, one per line, into JSON trees.")
+    args.add_argument("grammar", help="grammar file, JSON or compiled")
+    args.add_argument("input", nargs="?", type=argparse.FileType("r"), default=stdin,
+                      help="sentences to parse (default: stdin)")
+    args.add_argument("-o", "--output", type=argparse.FileType("w"), default=stdout,
+                      help="where to write the trees (default: stdout)")
+    args.add_argument("--algo", default="Earley", choices=["CKY", "NumpyCKY", "AStar", "Earley"],
+                      help="parsing algorithm (default: Earley)")
+    args.add_argument("--workers", type=int, default=1, help="number of worker processes")
+    args.add_argument("--gold", type=argparse.FileType("r"),
+                      help="gold trees, one per line, to evaluate against while parsing")
+    args = args.parse_args(argv)
+
+    start = time()
+    pcfg = PCFG()
+    pcfg.load(args.grammar)
+    parser = Parser(pcfg)
+    print("Grammar loaded in (%.2f)s" % (time() - start), file=stderr)
+
+    stats = WorkerStats()
+    results = parse_stream(parser, args.algo, args.input, args.workers,
+                           grammar_file=args.grammar, stats=stats)
+    if args.gold:
+        evaluator = ParseEvaluator()
+        results = evaluate(results, read_trees(args.gold), evaluator)
+
+    p_start = time()
+    written, failures = write_trees(results, args.output)
+    p_time = time() - p_start
+    args.output.flush()
+
+    print("Parsed %d sentences in (%.2f)s, %.2f sentences/s" % (
+        written, p_time, written / p_time if p_time else 0.0), file=stderr)
+    if args.workers > 1:
+        stats.output(file=stderr)
+    print("Failed parsings:", failures, file=stderr)
+    if args.gold:
+        evaluator.output(file=stderr)
+
+
+if __name__ == '__main__':
+    main()
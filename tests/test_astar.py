@@ -0,0 +1,34 @@
+'''
+Tests that A* builds the same trees as CKY.
+'''
+
+import pytest
+
+from mylib.eval import ParseError
+from mylib.parser import Parser
+from mylib.pcfg import PCFG
+
+
+@pytest.fixture(scope='module')
+def parser():
+    pcfg = PCFG()
+    pcfg.load('data/dev_grammar.dat')
+    assert not pcfg.compiled.has_unary_rules
+    return Parser(pcfg)
+
+
+def parse(function, sentence):
+    try:
+        return function(sentence)
+    except ParseError:
+        return None
+
+
+@pytest.mark.parametrize('log_space', [False, True])
+def test_same_trees_as_CKY(parser, log_space):
+    parser.log_space = log_space
+    with open('data/dev.raw') as sentences:
+        sentences = [line for line in sentences if len(line.split()) <= 15]
+    assert sentences
+    for sentence in sentences:
+        assert parse(parser.parse_AStar, sentence) == parse(parser.parse_CKY, sentence)
@@ -0,0 +1,35 @@
+'''
+Tests of the parse cache: its LRU eviction and its SQLite file.
+'''
+
+from mylib.cache import ParseCache
+
+TREE = ['S', ['NP', 'I'], ['VP', 'run']]
+
+
+def test_evicts_least_recently_used():
+    cache = ParseCache(max_entries=2)
+    cache.put('a', TREE)
+    cache.put('b', None)
+    # Looking a up makes b the least recently used
+    assert cache.get('a') == (True, TREE)
+    cache.put('c', TREE)
+    assert cache.get('b') == (False, None)
+    assert cache.get('a') == (True, TREE)
+    assert cache.get('c') == (True, TREE)
+    assert cache.evictions == 1
+
+
+def test_sqlite_round_trip(tmp_path):
+    path = str(tmp_path / 'parses.db')
+    cache = ParseCache(path=path)
+    cache.put('tree', TREE)
+    cache.put('failure', None)
+    cache.close()
+
+    # Another run reads the results back, failures included
+    cache = ParseCache(max_entries=1, path=path)
+    assert cache.get('tree') == (True, TREE)
+    assert cache.get('failure') == (True, None)
+    assert cache.get('missing') == (False, None)
+    cache.close()
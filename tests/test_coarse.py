@@ -0,0 +1,56 @@
+'''
+Tests of the coarse pass of coarse-to-fine parsing and of the pruning it does.
+'''
+
+from mylib.coarse import CoarseToFineStats, prune_chart
+from mylib.eval import ParseError
+from mylib.extract import TreebankCounts
+from mylib.parser import Parser
+from mylib.pcfg import PCFG
+
+
+def right_branching_pcfg(p):
+    # X -> A X with probability p, else X -> A A, and A -> a: the sentence of
+    # n words a has a single tree, of probability about p ** (n - 2)
+    counts = TreebankCounts()
+    counts.sym_count.update({'A': 10, 'X': round(1 / p)})
+    counts.unary_count['A', 'a'] = 10
+    counts.words_count['a'] = 10
+    counts.binary_count['X', 'A', 'X'] = 1
+    counts.binary_count['X', 'A', 'A'] = round(1 / p) - 1
+    pcfg = PCFG()
+    pcfg.learn_from_counts(counts)
+    return pcfg
+
+
+def test_long_sentence_keeps_pruning():
+    # The tree of 41 words scores about 1e-390, below the smallest float
+    pcfg = right_branching_pcfg(1e-10)
+    norm_words = [('a', 'a')] * 41
+    stats = CoarseToFineStats()
+    allowed = prune_chart(pcfg, norm_words, 1e-4, stats)
+    assert allowed is not None
+    assert stats.pruned() > 0
+    X = pcfg.compiled.symbol_ids['X']
+    # Only the spans of the tree keep X
+    assert all(allowed[Min, 40, X] for Min in range(40))
+    assert not any(allowed[0, Max, X] for Max in range(40))
+
+
+def test_loose_threshold_prunes_and_keeps_the_tree():
+    pcfg = PCFG()
+    pcfg.load('data/dev_grammar.dat')
+    parser = Parser(pcfg)
+    with open('data/dev.raw') as sentences:
+        sentences = [line for line in sentences if len(line.split()) <= 12]
+    assert sentences
+    for sentence in sentences:
+        parser.configure(coarse_threshold=None)
+        try:
+            expected = parser.parse_CKY(sentence)
+        except ParseError:
+            continue
+        parser.configure(coarse_threshold=1e-6)
+        assert parser.parse_CKY(sentence) == expected
+        assert parser.stats.fallbacks == 0
+        assert parser.stats.pruned() > 0
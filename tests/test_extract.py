@@ -0,0 +1,41 @@
+'''
+Tests of the treebank counts: counted in parallel, and cached as a grammar.
+'''
+
+from json import loads
+
+import pytest
+
+from mylib import pcfg as pcfg_module
+from mylib.extract import TreebankCounts, count_treebank
+from mylib.pcfg import PCFG
+
+TREEBANK = 'data/dev_cnf.dat'
+COUNTERS = ('sym_count', 'unary_count', 'unary_rule_count', 'binary_count', 'words_count')
+
+
+def test_parallel_counts_are_the_sequential_ones():
+    expected = TreebankCounts()
+    with open(TREEBANK) as trees:
+        for line in trees:
+            expected.count(loads(line))
+    for workers in (1, 3):
+        counts = count_treebank(TREEBANK, workers=workers)
+        for counter in COUNTERS:
+            assert getattr(counts, counter) == getattr(expected, counter)
+
+
+def test_cached_grammar_is_loaded(tmp_path, monkeypatch):
+    learned = PCFG()
+    learned.learn_from_treebank(TREEBANK, cache_dir=str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 1
+
+    def count_treebank(*args):
+        pytest.fail('the treebank was counted again')
+    monkeypatch.setattr(pcfg_module, 'count_treebank', count_treebank)
+    cached = PCFG()
+    cached.learn_from_treebank(TREEBANK, cache_dir=str(tmp_path))
+    assert cached.q1 == learned.q1
+    assert cached.q2 == learned.q2
+    assert cached.q3 == learned.q3
+    assert cached.well_known_words == learned.well_known_words
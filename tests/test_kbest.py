@@ -0,0 +1,29 @@
+'''
+Tests of the k-best trees: best first, starting with the CKY tree.
+'''
+
+import pytest
+
+from mylib.parser import Parser
+from mylib.pcfg import PCFG
+
+
+@pytest.fixture(scope='module')
+def parser():
+    pcfg = PCFG()
+    pcfg.load('data/dev_grammar.dat')
+    return Parser(pcfg)
+
+
+@pytest.mark.parametrize('log_space', [False, True])
+def test_best_first_from_the_CKY_tree(parser, log_space):
+    parser.log_space = log_space
+    with open('data/dev.raw') as sentences:
+        sentences = [line for line in sentences if len(line.split()) <= 12]
+    assert sentences
+    for sentence in sentences:
+        trees = parser.parse_kbest(sentence, 10)
+        assert len(trees) == 10
+        assert trees[0][0] == parser.parse_CKY(sentence)
+        scores = [score for _, score in trees]
+        assert scores == sorted(scores, reverse=True)
@@ -0,0 +1,58 @@
+'''
+Tests that the profiler counts every sentence once, with its own phase times.
+'''
+
+from json import loads
+
+import pytest
+
+from mylib.metrics import ParseProfiler
+from mylib.parser import Parser
+from mylib.pcfg import PCFG
+from mylib.schedule import Budget, parse_scheduled
+
+
+def profiled_parser(metrics):
+    pcfg = PCFG()
+    pcfg.load('data/dev_grammar.dat')
+    parser = Parser(pcfg)
+    parser.profiler = ParseProfiler(str(metrics))
+    return parser
+
+
+@pytest.mark.parametrize('budget', [
+    # Only the shortest sentences fit the chart, the others take the fallbacks
+    Budget(cells=45),
+    # Every strategy but the flat tree runs out of time
+    Budget(seconds=0.0),
+])
+def test_fallback_run(tmp_path, budget):
+    metrics = tmp_path / 'metrics.jsonl'
+    parser = profiled_parser(metrics)
+    with open('data/dev.raw') as sentences:
+        sentences = [line for line in sentences if len(line.split()) <= 20]
+    strategies = []
+    for sentence in sentences:
+        tree, failed, (tokens, _, strategy) = parse_scheduled(parser, 'CKY', sentence, budget)
+        strategies.append((tokens, strategy, failed))
+        assert parser.profiler.row == {}
+    parser.profiler.close()
+
+    assert any(strategy != 'CKY' for _, strategy, _ in strategies)
+    assert parser.profiler.sentences == len(sentences)
+    rows = [loads(line) for line in open(str(metrics))]
+    assert [(row['tokens'], row['failed']) for row in rows] == \
+        [(tokens, failed) for tokens, _, failed in strategies]
+    for row in rows:
+        assert row['tokenize'] > 0 and row['normalize'] > 0 and row['parse'] > 0
+
+
+def test_flat_parse(tmp_path):
+    metrics = tmp_path / 'metrics.jsonl'
+    parser = profiled_parser(metrics)
+    parser.parse_Flat('The cat sat .')
+    assert parser.profiler.row == {}
+    parser.parse_CKY('The cat sat .')
+    parser.profiler.close()
+    rows = [loads(line) for line in open(str(metrics))]
+    assert [(row['algo'], row['tokens']) for row in rows] == [('Flat', 4), ('CKY', 4)]
@@ -0,0 +1,55 @@
+'''
+Tests that the vectorized CKY builds the same trees as the dict CKY.
+'''
+
+from json import loads
+
+import pytest
+
+from mylib.eval import ParseError
+from mylib.extract import TreebankCounts
+from mylib.parser import Parser
+from mylib.pcfg import PCFG
+
+
+def uncollapse(tree):
+    # The tree with its X+Y nodes as chains of unary rules
+    if len(tree) == 2 and isinstance(tree[1], str):
+        children = [tree[1]]
+    else:
+        children = [uncollapse(child) for child in tree[1:]]
+    labels = tree[0].split('+')
+    node = [labels[-1]] + children
+    for label in reversed(labels[:-1]):
+        node = [label, node]
+    return node
+
+
+@pytest.fixture(scope='module')
+def unary_parser():
+    # A grammar with unary rules between symbols, learned from the dev trees
+    counts = TreebankCounts()
+    with open('data/dev_cnf.dat') as trees:
+        for line in trees:
+            counts.count(uncollapse(loads(line)))
+    pcfg = PCFG()
+    pcfg.learn_from_counts(counts)
+    assert pcfg.compiled.has_unary_rules
+    return Parser(pcfg)
+
+
+def parse(function, sentence):
+    try:
+        return function(sentence)
+    except ParseError:
+        return None
+
+
+@pytest.mark.parametrize('threshold', [None, -8, -3, -1])
+def test_unary_grammar_thresholds(unary_parser, threshold):
+    unary_parser.log_space = True
+    unary_parser.threshold = threshold
+    with open('data/dev.raw') as sentences:
+        sentences = [line for line in sentences if len(line.split()) <= 12]
+    for sentence in sentences:
+        assert parse(unary_parser.parse_NumpyCKY, sentence) == parse(unary_parser.parse_CKY, sentence)